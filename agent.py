@@ -23,6 +23,27 @@ event-script {
     }
 }
 
+Batching (optional):
+    Add 'mode spool' to the Webhooks policy arguments, so events are saved
+    Then send the saved events as one batch, on a timer:
+
+[edit event-options]
+generate-event {
+    agent-flush time-interval 60;
+}
+policy WebhooksFlush {
+    events agent-flush;
+    then {
+        event-script junos-agent.py {
+            arguments {
+                mode flush;
+                url <DESTINATION>;
+                secret <SECRET>;
+            }
+        }
+    }
+}
+
 https://www.juniper.net/documentation/us/en/software/junos/automation-scripting/topics/concept/junos-script-automation-event-script-input.html
 
 
@@ -31,58 +52,338 @@ Assumes junos 21.2R1 and later
 '''
 
 
-import requests
 import json
 import argparse
+import fcntl
+import gzip
+import os
+import random
+import heapq
 import hmac
 import hashlib
+import secrets
+import time
 
 from junos import Junos_Trigger_Event
-from jnpr.junos import Device
 
 
-# Collect top 4 CPU users
-def top():
+# Events are spooled here, and moved to SENDING while being sent
+#   The spool is limited in size (bytes), to protect device storage
+SPOOL = '/var/tmp/junos-agent.spool'
+SENDING = '/var/tmp/junos-agent.sending'
+SPOOL_MAX = 1048576
+
+# Many copies of this script can run at once, so files are locked
+#   SPOOL_LOCK is held while the spool is changed (briefly)
+#   FLUSH_LOCK is held by the one process that owns SENDING
+SPOOL_LOCK = '/var/tmp/junos-agent.spool.lock'
+FLUSH_LOCK = '/var/tmp/junos-agent.flush.lock'
+
+# The compact wire format, and its event IDs
+#   These must match wire.py in the plugin; only add to the end
+WIRE_FORMAT = 'compact-1'
+EVENT_IDS = [
+    'DH_SVC_SENDMSG_FAILURE',
+    'LACP_INTF_MUX_STATE_CHANGED',
+    'LICENSE_EXPIRED_KEY_DELETED',
+    'SYSTEM_ABNORMAL_SHUTDOWN',
+    'TOPO_CH',
+    'UI_COMMIT',
+    'UI_COMMIT_NOT_CONFIRMED',
+    'UI_REBOOT_EVENT',
+    'UTMD_CF_CONFIG_DEPRECATED',
+    'ROOT_PORT',
+    'RTPERF_CPU_THRESHOLD_EXCEEDED',
+    'RTPERF_CPU_UTIL_MAX',
+    'SNMP_TRAP_LINK_DOWN',
+    'SNMP_TRAP_LINK_UP',
+]
+
+# HTTP timeouts (seconds), and retries with backoff (seconds)
+CONNECT_TIMEOUT = 3
+READ_TIMEOUT = 5
+RETRIES = 2
+BACKOFF = 1
+
+# Results from send()
+#   FAILED (no response, or a server error) is worth sending again later
+#   REJECTED (a client error, like 400 or 413) will never be accepted
+SENT = 'sent'
+FAILED = 'failed'
+REJECTED = 'rejected'
+
+# Client errors that are worth retrying (timeout, and too many requests)
+RETRY_STATUS = (408, 429)
+
+# A batch the server rejected is moved here, so it isn't sent again
+#   Only the last rejected batch is kept, to protect device storage
+REJECTED_BATCH = '/var/tmp/junos-agent.rejected'
+
+
+# Get the processes from the structured RPC
+#   Yields a dictionary for each process
+def processes(result):
+    for proc in result.iter('process'):
+        cpu = proc.findtext('cpu-load') or \
+            proc.findtext('percentage-cpu-usage') or '0'
+        yield {
+            'pid': (proc.findtext('pid') or '').strip(),
+            'user': (proc.findtext('username') or '').strip(),
+            'cpu': float(cpu.strip().replace("%", "") or 0),
+            'command': (proc.findtext('command') or '').strip()
+        }
+
+
+# Get the processes from the text output, if there's no structured output
+#   Columns are found from the header, not fixed line offsets
+def processes_text(text):
+    header = None
+    for line in text.splitlines():
+        item = line.split()
+        if not item:
+            continue
+
+        if item[0] == 'PID' and 'WCPU' in item:
+            header = item
+            continue
+        if header is None or not item[0].isdigit():
+            continue
+
+        # The command is the last column, and may contain spaces
+        command = ' '.join(item[len(header) - 1:])
+        yield {
+            'pid': item[0],
+            'user': item[header.index('USERNAME')],
+            'cpu': float(item[header.index('WCPU')].replace("%", "")),
+            'command': command
+        }
+
+
+# Collect the top CPU users
+#   'count' is the number of processes to return
+#   'exclude' is a list of process names to ignore
+def top(count=4, exclude=None):
+    from jnpr.junos import Device
+
+    exclude = exclude or []
+
     with Device() as jdev:
-        cmd1 = jdev.cli('show system processes extensive')
-
-    full_list = cmd1.split("\n")
-    proc_list = []
-    top_counter = 0
-
-    # Use a range to skip the summary at the beginning
-    for item in full_list[9:-1]:
-        if ('0.00%' not in item) and ('flowd_octeon_hm' not in item):
-            # Only collect the top 4 processes (by CPU)
-            if top_counter >= 4:
-                break
-
-            # Cleanup the data before working with it
-            item = item.strip()
-            item = item.split()
-
-            # Sometimes the command has a space in it
-            # Convert this back into a string
-            if len(item) > 11:
-                item[10] = f"{item[10]} {item[11]}"
-
-            # Save the relevant details as a dictionary
-            # Save the cpu as a float, not a string
-            proc = {
-                'pid': item[0],
-                'user': item[1],
-                'cpu': float(item[9].replace("%", "")),
-                'command': item[10]
-            }
-            proc_list.append(proc)
-            top_counter += 1
+        result = jdev.rpc.get_system_process_information(extensive=True)
 
-    return proc_list
+    # Some platforms only return text, wrapped in an <output> tag
+    if result.find('.//process') is not None:
+        proc_list = processes(result)
+    else:
+        proc_list = processes_text(''.join(result.itertext()))
+
+    # Keep only the busiest processes, without sorting the whole list
+    busy = (
+        proc for proc in proc_list
+        if proc['cpu'] > 0 and
+        not any(name in proc['command'] for name in exclude)
+    )
+    return heapq.nlargest(count, busy, key=lambda proc: proc['cpu'])
 
 
-# Create a hash, using the body of the request, and a secret
+# Create a hash, using the body of the request (bytes), and a secret
 def create_hash(body, secret):
-    return hmac.new(secret.encode(), body.encode(), hashlib.sha256).hexdigest()
+    return hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+# Create a signature that also covers a timestamp and a one-time nonce
+#   This lets the receiver reject old or replayed webhooks
+def create_signature(body, secret, timestamp, nonce):
+    return create_hash(f"{timestamp}.{nonce}.".encode() + body, secret)
+
+
+# Convert an event to the compact format
+#   Short keys, numeric event IDs, and no event name in the message
+#   This must match wire.py in the plugin
+def compact(data):
+    event = data['event']
+    message = (data.get('message') or '').replace(event, '', 1)
+
+    detail = data.get('detail') or ''
+    if isinstance(detail, list):
+        detail = [
+            [proc['pid'], proc['user'], proc['cpu'], proc['command']]
+            for proc in detail
+        ]
+
+    small = {
+        'e': EVENT_IDS.index(event) if event in EVENT_IDS else event,
+        'p': data.get('process'),
+        'm': message,
+        'h': data.get('hostname')
+    }
+    if detail:
+        small['d'] = detail
+    return small
+
+
+# Send a webhook, signed with the secret
+#   'data' can be a single event, or a list of events
+#   'compact' uses the compact format, and 'compress' gzips the body
+#   Timeouts and a limited number of retries keep the script slot free
+#   Returns SENT, FAILED, or REJECTED
+def send(data, url, secret, compact_format=False, compress=False):
+    import requests
+
+    headers = {'Content-type': 'application/json'}
+
+    if compact_format:
+        if isinstance(data, list):
+            data = [compact(event) for event in data]
+        else:
+            data = compact(data)
+        body = json.dumps(data, separators=(',', ':')).encode()
+        headers['Junos-Format'] = WIRE_FORMAT
+    else:
+        body = json.dumps(data).encode()
+
+    if compress:
+        body = gzip.compress(body)
+        headers['Content-Encoding'] = 'gzip'
+
+    headers['Junos-Auth'] = create_hash(body, secret)
+
+    for attempt in range(RETRIES + 1):
+        # Wait before retrying, with jitter so devices don't retry together
+        if attempt > 0:
+            time.sleep(BACKOFF * (2 ** (attempt - 1)) + random.uniform(0, 1))
+
+        # A fresh timestamp and nonce for each attempt
+        timestamp = str(int(time.time()))
+        nonce = secrets.token_hex(16)
+        headers['Junos-Timestamp'] = timestamp
+        headers['Junos-Nonce'] = nonce
+        headers['Junos-Signature'] = create_signature(
+            body, secret, timestamp, nonce
+        )
+
+        try:
+            req = requests.post(
+                url,
+                data=body,
+                headers=headers,
+                timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)
+            )
+        except Exception as err:
+            print("Error occurred sending the webhook")
+            print(err)
+            continue
+
+        if req.status_code < 300:
+            return SENT
+
+        print(f"Webhook rejected with status {req.status_code}")
+
+        # Client errors (eg, a bad request) won't be fixed by retrying
+        if req.status_code < 500 and req.status_code not in RETRY_STATUS:
+            return REJECTED
+
+    return FAILED
+
+
+# Open and lock a lock file
+#   Returns the open file (close it to unlock), or None if 'wait' is False
+#   and another process holds the lock
+def lock(path, wait=True):
+    lock_file = open(path, 'a')
+    try:
+        fcntl.flock(
+            lock_file,
+            fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB
+        )
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+# Get the size of a file, or 0 if it doesn't exist
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+# Add an event to the spool file, to be sent later by flush()
+#   Each event is one line of JSON
+#   If the spool is full, the event is dropped to protect device storage
+def spool(data):
+    with lock(SPOOL_LOCK):
+        if file_size(SPOOL) + file_size(SENDING) >= SPOOL_MAX:
+            print("Spool is full, dropping the event")
+            return
+
+        with open(SPOOL, 'a') as spool_file:
+            spool_file.write(json.dumps(data) + '\n')
+
+
+# Send all spooled events as one batch
+#   Only one process flushes at a time; others return straight away,
+#   as their events will be sent by the flush that's running
+#   The spool is moved into SENDING first, so new events go to a fresh file
+#   If sending fails, the batch is kept and sent with the next flush
+#   If the server rejects the batch, it's moved to REJECTED_BATCH instead
+def flush(url, secret, **options):
+    flush_lock = lock(FLUSH_LOCK, wait=False)
+    if flush_lock is None:
+        return
+
+    with flush_lock:
+        with lock(SPOOL_LOCK):
+            if os.path.exists(SPOOL):
+                with open(SPOOL) as new, open(SENDING, 'a') as sending:
+                    sending.write(new.read())
+                os.remove(SPOOL)
+
+        events = []
+        try:
+            with open(SENDING) as sending:
+                for line in sending:
+                    try:
+                        events.append(json.loads(line))
+                    except ValueError:
+                        pass
+        except FileNotFoundError:
+            return
+
+        # SENDING is only changed while holding FLUSH_LOCK, so nothing
+        #   was added to it while the batch was being sent
+        result = send(events, url, secret, **options) if events else SENT
+        if result == SENT:
+            with lock(SPOOL_LOCK):
+                os.remove(SENDING)
+
+        # Sending this batch again won't help, and it would fill the spool
+        elif result == REJECTED:
+            print(f"Batch rejected, moving it to {REJECTED_BATCH}")
+            with lock(SPOOL_LOCK):
+                os.replace(SENDING, REJECTED_BATCH)
+
+
+# Collect details of the event that triggered this script
+def collect_event():
+    data = {
+        'event': Junos_Trigger_Event.xpath('//trigger-event/id')[0].text,
+        'process':
+            Junos_Trigger_Event.xpath('//trigger-event/process/name')[0].text,
+        'message':
+            Junos_Trigger_Event.xpath('//trigger-event/message')[0].text,
+        'hostname':
+            Junos_Trigger_Event.xpath('//trigger-event/hostname')[0].text,
+        'detail': ''
+    }
+
+    # Add special handling, depending on the event
+    if 'RTPERF_CPU' in data['event']:
+        exclude = [name for name in args.exclude.split(',') if name]
+        data['detail'] = top(args.top, exclude)
+
+    return data
 
 
 # Setup arguments
@@ -91,36 +392,57 @@ parser = argparse.ArgumentParser(description=helpmsg)
 
 parser.add_argument("-url", help="URL to send webhooks to")
 parser.add_argument("-secret", help="URL to send webhooks to")
+parser.add_argument(
+    "-mode",
+    default="send",
+    choices=["send", "spool", "flush"],
+    help="send now, spool for later, or flush the spool as a batch"
+)
+parser.add_argument(
+    "-top",
+    type=int,
+    default=4,
+    help="Number of processes to report on CPU events"
+)
+parser.add_argument(
+    "-exclude",
+    default="flowd_octeon_hm",
+    help="Comma separated process names to ignore on CPU events"
+)
+parser.add_argument(
+    "-compact",
+    action="store_true",
+    help="Use the compact format (short keys, numeric event IDs)"
+)
+parser.add_argument(
+    "-gzip",
+    action="store_true",
+    help="Compress the webhook body with gzip (needs handle_webhook())"
+)
 args = parser.parse_args()
 
 
-# Data to send
-data = {
-    'event': Junos_Trigger_Event.xpath('//trigger-event/id')[0].text,
-    'process': Junos_Trigger_Event.xpath('//trigger-event/process/name')[0].text,
-    'message': Junos_Trigger_Event.xpath('//trigger-event/message')[0].text,
-    'hostname': Junos_Trigger_Event.xpath('//trigger-event/hostname')[0].text,
-    'detail': ''
-}
-
-# Add special handling, depending on the event
-if 'RTPERF_CPU' in data['event']:
-    data['detail'] = top()
-
-body = json.dumps(data)
-auth_header = create_hash(body, args.secret)
-
-
 # Send information as a webhook
-try:
-    req = requests.post(
-        args.url,
-        data=body,
-        headers={
-            'Content-type': 'application/json',
-            'Junos-Auth': auth_header
-        }
-    )
-except Exception as err:
-    print("Error occurred sending the webhook")
-    print(err)
+#   In 'spool' mode, the event is saved and sent later by 'flush'
+#   In 'send' mode, a failed event is spooled, and any spooled events
+#   are replayed after the next successful send
+#   An event the server rejects is dropped, as it would never be accepted
+#   Sends only flush if something is spooled, and never wait for (or
+#   repeat) a flush that another copy of the agent is already running
+options = {'compact_format': args.compact, 'compress': args.gzip}
+
+match args.mode:
+    case "send":
+        event = collect_event()
+        result = send(event, args.url, args.secret, **options)
+        if result == SENT:
+            if file_size(SPOOL) or file_size(SENDING):
+                flush(args.url, args.secret, **options)
+        elif result == FAILED:
+            spool(event)
+        else:
+            print("Event rejected, dropping it")
+    case "spool":
+        spool(collect_event())
+    case "flush":
+        flush(args.url, args.secret, **options)
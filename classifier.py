@@ -0,0 +1,232 @@
+"""
+Classifies Junos events into priority levels
+The classifier is built once from the config, and reused for every event
+
+Usage:
+    Create an EventClassifier from the 'events' and 'rules' config sections
+    Call classify() with the event name, hostname, and message
+
+Event Patterns:
+    'UI_COMMIT' - Exact match (hash lookup)
+    'RTPERF_CPU_*' - Prefix match (trie lookup, longest prefix wins)
+    '*_CPU_*' - Any other wildcard (glob, combined into one regex)
+    're:^RPD_.*_DOWN$' - A regular expression
+
+    Exact matches are checked first, then prefixes, then regular expressions
+
+Rules:
+    Rules can also match on the hostname (glob) and message (regex)
+    Rules are checked before the event patterns, in the order they're listed
+    The first rule to match sets the level
+    Only rules whose event pattern matches are checked
+        Rules with no event pattern apply to every event
+
+Cache:
+    The matching rules and level for each event name are found once,
+        and cached (up to CACHE_SIZE event names)
+    After that, an event is a dictionary lookup, and a check of its rules
+
+Levels:
+    Events (or rules) listed with no level are ignored, as level 4 is
+    Events that don't match anything use the default level
+
+Restrictions:
+    Regular expressions should not use named groups
+
+To Do:
+    None
+"""
+
+import fnmatch
+import heapq
+import re
+
+
+# The level for events that are listed with no level (they're ignored)
+IGNORE = 4
+
+# The most event names to cache matches for
+CACHE_SIZE = 4096
+
+
+# Build a regular expression from an event pattern
+#   Returns None for exact and prefix patterns
+def pattern_regex(pattern):
+    if pattern.startswith('re:'):
+        return pattern[3:]
+    if any(char in pattern for char in '*?['):
+        return fnmatch.translate(pattern)
+    return None
+
+
+# Check if a pattern is a simple prefix (eg, 'RTPERF_CPU_*')
+def is_prefix(pattern):
+    return (
+        pattern.endswith('*') and
+        not pattern.startswith('re:') and
+        not any(char in pattern[:-1] for char in '*?[')
+    )
+
+
+# Maps event names to values, using exact, prefix and regex patterns
+class PatternIndex:
+    def __init__(self):
+        self.exact = {}
+        self.trie = {}
+        self.patterns = []
+        self.regex = None
+        self.regex_list = []
+
+    # Add a pattern, and the value to return when it matches
+    def add(self, pattern, value):
+        if is_prefix(pattern):
+            node = self.trie
+            for char in pattern[:-1]:
+                node = node.setdefault(char, {})
+            node[None] = value
+
+        elif pattern_regex(pattern) is not None:
+            self.patterns.append((pattern_regex(pattern), value))
+
+        else:
+            self.exact[pattern] = value
+
+    # Compile the regular expressions into one
+    #   Must be called after all patterns are added
+    def compile(self):
+        self.regex_list = [
+            (re.compile(regex), value) for regex, value in self.patterns
+        ]
+        if self.patterns:
+            self.regex = re.compile('|'.join(
+                f'(?P<p{number}>{regex})'
+                for number, (regex, _) in enumerate(self.patterns)
+            ))
+
+    # Get the value for the best matching pattern, or None
+    def lookup(self, event):
+        if event in self.exact:
+            return self.exact[event]
+
+        # Walk the trie, remembering the longest prefix that matched
+        found = False
+        best = None
+        node = self.trie
+        for char in event:
+            if None in node:
+                found, best = True, node[None]
+            node = node.get(char)
+            if node is None:
+                break
+        else:
+            if None in node:
+                found, best = True, node[None]
+        if found:
+            return best
+
+        if self.regex is not None:
+            match = self.regex.fullmatch(event)
+            if match:
+                return self.patterns[int(match.lastgroup[1:])][1]
+
+        return None
+
+    # Get the values for every matching pattern
+    #   The combined regex is checked first, so most events skip the
+    #   individual regular expressions
+    def lookup_all(self, event):
+        values = []
+        if event in self.exact:
+            values.append(self.exact[event])
+
+        node = self.trie
+        for char in event:
+            if None in node:
+                values.append(node[None])
+            node = node.get(char)
+            if node is None:
+                break
+        else:
+            if None in node:
+                values.append(node[None])
+
+        if self.regex is not None and self.regex.fullmatch(event):
+            for regex, value in self.regex_list:
+                if regex.fullmatch(event):
+                    values.append(value)
+
+        return values
+
+
+# Classifies events into priority levels
+class EventClassifier:
+    def __init__(self, events, rules=None, default=1):
+        self.default = default
+
+        # Event patterns
+        #   A null level (eg, 'UI_COMMIT_NOT_CONFIRMED:') ignores the event
+        self.events = PatternIndex()
+        for pattern, level in (events or {}).items():
+            self.events.add(
+                str(pattern),
+                IGNORE if level is None else level
+            )
+        self.events.compile()
+
+        # Rules, indexed by their event pattern
+        #   Each entry is (order, hostname regex, message regex, level)
+        #   Entries are added in order, so each pattern's list is sorted
+        grouped = {}
+        for order, rule in enumerate(rules or []):
+            hostname = rule.get('hostname')
+            message = rule.get('message')
+            entry = (
+                order,
+                re.compile(fnmatch.translate(hostname), re.IGNORECASE)
+                if hostname else None,
+                re.compile(message) if message else None,
+                IGNORE if rule.get('level') is None else rule['level']
+            )
+            grouped.setdefault(str(rule.get('event', '*')), []).append(entry)
+
+        self.rules = PatternIndex()
+        for pattern, entries in grouped.items():
+            self.rules.add(pattern, entries)
+        self.rules.compile()
+
+        # Matches for each event name, as (rules, level)
+        self.cache = {}
+
+    # Find the rules and level for an event name, and cache them
+    #   Each pattern's rules are already sorted, so they're merged in order
+    def match_event(self, event):
+        rules = tuple(
+            entry[1:] for entry in heapq.merge(*self.rules.lookup_all(event))
+        )
+
+        level = self.events.lookup(event)
+        if level is None:
+            level = self.default
+
+        # Start again if the cache is full, rather than growing forever
+        if len(self.cache) >= CACHE_SIZE:
+            self.cache.clear()
+        self.cache[event] = (rules, level)
+
+        return rules, level
+
+    # Get the level for an event
+    def classify(self, event, hostname='', message=''):
+        matched = self.cache.get(event)
+        if matched is None:
+            matched = self.match_event(event)
+        rules, level = matched
+
+        for host_regex, message_regex, rule_level in rules:
+            if host_regex and not host_regex.match(hostname or ''):
+                continue
+            if message_regex and not message_regex.search(message or ''):
+                continue
+            return rule_level
+
+        return level
@@ -0,0 +1,93 @@
+"""
+Caches decrypted device and server credentials, in memory only
+
+Usage:
+    Call get_secret() instead of crypto.pw_decrypt()
+    Call invalidate() when a login fails, so the next call decrypts again
+    Call is_auth_error() to check if a connection error was a failed login
+
+Cache:
+    Secrets are cached for 'credential_ttl' seconds
+    No more than 'credential_cache_size' secrets are cached;
+        the least recently used secret is removed when the cache is full
+    Failed decrypts are not cached
+    Secrets are never written to disk
+
+Restrictions:
+    A changed password is not seen until the secret expires,
+        or a login fails and the secret is invalidated
+
+To Do:
+    None
+"""
+
+from collections import OrderedDict
+from core import crypto
+from plugins.junos.settings import plugin_setting
+import threading
+import time
+
+
+# Default cache settings, used if they're not in the config
+CREDENTIAL_TTL = 300
+CREDENTIAL_CACHE_SIZE = 100
+
+# Cached secrets, least recently used first
+#   (dev_type, device) : {'secret': dict, 'expires': float}
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+# Build a cache key; device names are not case sensitive
+def _cache_key(dev_type, device):
+    return (dev_type, device.lower())
+
+
+# Get the credentials for a device or server
+#   Returns the secret from crypto.pw_decrypt(), or False
+def get_secret(dev_type, device):
+    key = _cache_key(dev_type, device)
+    now = time.monotonic()
+
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is not None and entry['expires'] > now:
+            _cache.move_to_end(key)
+            return entry['secret']
+        _cache.pop(key, None)
+
+    # Decrypt outside the lock, so other lookups aren't held up
+    secret = crypto.pw_decrypt(dev_type=dev_type, device=device)
+    if not secret:
+        return secret
+
+    with _cache_lock:
+        _cache[key] = {
+            'secret': secret,
+            'expires': now + plugin_setting('credential_ttl', CREDENTIAL_TTL)
+        }
+        _cache.move_to_end(key)
+
+        size = plugin_setting('credential_cache_size', CREDENTIAL_CACHE_SIZE)
+        while len(_cache) > size:
+            _cache.popitem(last=False)
+
+    return secret
+
+
+# Remove a secret from the cache, such as after a failed login
+def invalidate(dev_type, device):
+    with _cache_lock:
+        _cache.pop(_cache_key(dev_type, device), None)
+
+
+# Remove all secrets from the cache
+def clear():
+    with _cache_lock:
+        _cache.clear()
+
+
+# Check if an error from junos_connect() is a failed login
+def is_auth_error(err):
+    from jnpr.junos.exception import ConnectAuthError
+    return isinstance(err, ConnectAuthError)
@@ -0,0 +1,142 @@
+"""
+Caches the facts of each Junos device, so they can be used without
+    connecting to the device
+
+Usage:
+    Call get_facts(host) to get the cached facts for a device (or None)
+        This never connects to the device
+    Call get_facts(host, dev) with a connected device, to refresh the
+        facts if they are missing or out of date
+    Call describe(host) for a short description of a device, for messages
+
+Facts:
+    hostname, model, version, and cluster (True if an SRX cluster)
+
+Cache:
+    Facts are saved to FACTS_FILE in 'local_log_dir', so they survive restarts
+    Facts older than 'facts_ttl' seconds are refreshed,
+        the next time a workflow connects to the device
+    Log collection, reboots, and restarts all keep the cache up to date
+
+Restrictions:
+    Facts are only refreshed when a workflow is connected to the device,
+        so cached facts may be older than 'facts_ttl'
+
+To Do:
+    None
+"""
+
+from plugins.junos.settings import plugin_setting
+import json
+import os
+import tempfile
+import termcolor
+import threading
+import time
+
+
+# The file the facts are saved to, and how long they are used for (seconds)
+FACTS_FILE = 'device_facts.json'
+FACTS_TTL = 86400
+
+# Cached facts, loaded from FACTS_FILE when first used
+#   host : {'hostname': str, 'model': str, 'version': str,
+#           'cluster': bool, 'updated': float}
+_facts = None
+_facts_lock = threading.Lock()
+
+
+# Get the location of the facts file
+def _facts_path():
+    local_dir = plugin_setting('local_log_dir', tempfile.gettempdir())
+    return os.path.join(local_dir, FACTS_FILE)
+
+
+# Load the facts file, if it hasn't been loaded yet
+#   Must be called while holding _facts_lock
+def _load():
+    global _facts
+    if _facts is not None:
+        return
+
+    try:
+        with open(_facts_path()) as facts_file:
+            _facts = json.load(facts_file)
+    except (OSError, ValueError):
+        _facts = {}
+
+
+# Save the facts file
+#   Written to a temporary file first, so it's never half-written
+#   Must be called while holding _facts_lock
+def _save():
+    path = _facts_path()
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(f'{path}.tmp', 'w') as facts_file:
+            json.dump(_facts, facts_file)
+        os.replace(f'{path}.tmp', path)
+    except OSError as err:
+        print(termcolor.colored(f"Could not save device facts: {err}", "red"))
+
+
+# Check if cached facts are too old to use
+def _stale(entry):
+    age = time.time() - entry.get('updated', 0)
+    return age > plugin_setting('facts_ttl', FACTS_TTL)
+
+
+# Read the facts from a connected device, and cache them
+#   PyEZ only sends the RPCs needed for the facts that are read
+#   Returns the facts, or None if they could not be read
+def update_facts(host, dev):
+    try:
+        entry = {
+            'hostname': dev.facts['hostname'],
+            'model': dev.facts['model'],
+            'version': dev.facts['version'],
+            'cluster': bool(dev.facts['srx_cluster']),
+            'updated': time.time()
+        }
+    except Exception as err:
+        print(termcolor.colored(
+            f"Could not read facts from {host}: {err}",
+            "red"
+        ))
+        return None
+
+    with _facts_lock:
+        _load()
+        _facts[host.lower()] = entry
+        _save()
+
+    return entry
+
+
+# Get the facts for a device
+#   If 'dev' is a connected device, missing or old facts are read from it
+#   Otherwise, the cached facts are returned, even if they're old
+#   Returns the facts, or None if there are none cached
+def get_facts(host, dev=None):
+    with _facts_lock:
+        _load()
+        entry = _facts.get(host.lower())
+
+    if dev is not None and (entry is None or _stale(entry)):
+        return update_facts(host, dev) or entry
+
+    return entry
+
+
+# Describe a device from its cached facts, such as ' (SRX345, Junos 21.4R3)'
+#   This doesn't connect to the device
+#   Returns an empty string if there are no cached facts
+def describe(host):
+    entry = get_facts(host)
+    if entry is None:
+        return ''
+
+    text = f"{entry['model']}, Junos {entry['version']}"
+    if entry['cluster']:
+        text += ", cluster"
+    return f" ({text})"
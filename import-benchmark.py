@@ -0,0 +1,118 @@
+"""
+Measures how long the Junos plugin takes to import
+
+Usage:
+    Run independantly of the main plugin, from this directory
+    python import-benchmark.py [runs]
+
+Purpose:
+    Shows which heavy modules (PyEZ, lxml, dateutil) are loaded at import
+    Compares the plugin import time to the cost of those modules
+    Compares parsing entities.yaml to loading the pickled cache
+
+Restrictions:
+    Needs the chatbot (the 'core' and 'config' modules) to be importable
+    Each measurement runs in a fresh Python process, so nothing is cached
+
+To Do:
+    None
+"""
+
+import os
+import pickle
+import subprocess
+import sys
+import time
+import yaml
+
+
+CHATBOT = os.path.abspath('../../chatbot')
+HEAVY = ['jnpr', 'lxml', 'dateutil']
+
+# The plugin modules, as the chatbot imports them
+PLUGIN_MODULES = [
+    'plugins.junos.junos',
+    'plugins.junos.netconf',
+    'plugins.junos.jtac_logs',
+    'plugins.junos.reboot',
+    'plugins.junos.restart-proc',
+]
+
+# The heavy modules, imported directly
+HEAVY_MODULES = [
+    'jnpr.junos',
+    'jnpr.junos.utils.start_shell',
+    'lxml.etree',
+    'dateutil.parser',
+]
+
+
+# Import modules in a fresh process
+#   Returns the time taken (seconds), and which heavy modules were loaded
+def time_import(modules):
+    code = (
+        'import importlib, sys, time\n'
+        'start = time.perf_counter()\n'
+        f'for name in {modules!r}:\n'
+        '    importlib.import_module(name)\n'
+        'print(time.perf_counter() - start)\n'
+        f'print(",".join(m for m in {HEAVY!r} if m in sys.modules))\n'
+    )
+    result = subprocess.run(
+        [sys.executable, '-c', code],
+        cwd=CHATBOT,
+        capture_output=True,
+        text=True
+    )
+    if result.returncode != 0:
+        print(result.stderr)
+        return None, ''
+
+    lines = result.stdout.strip().splitlines()
+    return float(lines[-2]), lines[-1]
+
+
+# Average the import time over a number of runs
+def average(modules, runs):
+    times = []
+    loaded = ''
+    for _ in range(runs):
+        taken, loaded = time_import(modules)
+        if taken is None:
+            return None, ''
+        times.append(taken)
+    return sum(times) / len(times), loaded
+
+
+# Compare parsing a YAML file to loading a pickled copy
+def time_yaml(path, runs):
+    start = time.perf_counter()
+    for _ in range(runs):
+        with open(path) as yaml_file:
+            data = yaml.load(yaml_file, Loader=yaml.FullLoader)
+    parsed = (time.perf_counter() - start) / runs
+
+    cached = pickle.dumps(data)
+    start = time.perf_counter()
+    for _ in range(runs):
+        pickle.loads(cached)
+    unpickled = (time.perf_counter() - start) / runs
+
+    return parsed, unpickled
+
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    plugin_time, loaded = average(PLUGIN_MODULES, runs)
+    heavy_time, _ = average(HEAVY_MODULES, runs)
+
+    if plugin_time is not None:
+        print(f"Plugin import:        {plugin_time * 1000:8.1f} ms")
+        print(f"Heavy modules loaded: {loaded or 'none'}")
+    if heavy_time is not None:
+        print(f"PyEZ/lxml/dateutil:   {heavy_time * 1000:8.1f} ms (deferred)")
+
+    parsed, unpickled = time_yaml('entities.yaml', runs * 20)
+    print(f"entities.yaml parse:  {parsed * 1000:8.2f} ms")
+    print(f"entities.yaml cache:  {unpickled * 1000:8.2f} ms")
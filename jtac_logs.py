@@ -6,8 +6,11 @@ Supports username and password for login to NETCONF over SSH
 Junos supports RSA keys, but this script currently does not
 
 Modules:
-    3rd Party: JunosPyEz (junos-eznc), datetime, termcolor, threading
-    Internal: core/teamschat, core/crypto, config.plugin_list
+    3rd Party: JunosPyEz (junos-eznc, through netconf), termcolor
+    Standard: datetime, ftplib, io, json, os, re, tarfile, tempfile, threading,
+        concurrent.futures
+    Internal: core/teamschat, config.plugin_list, credentials, facts,
+        progress, settings
 
 Classes:
 
@@ -17,8 +20,30 @@ Functions
 
     get_logs()
         Extract details from the users request
+    get_commands()
+        Get the extensive commands for the profiles in the users request
+    collect_logs()
+        Collect logs from many devices, with bounded concurrency
+    submit_site()
+        Submit one site's jobs to the shared pool, as site slots free up
+    device_error()
+        Report a device error, after sending any held progress updates
     get_rsi()
         Collect logs from the device, and upload to FTP
+    list_logs() / changed_logs()
+        Find logs that have changed since the last collection
+    archive_files()
+        Archive a list of files on the device
+    extensive_logs()
+        Collect extensive logs from the device, and upload to FTP
+    run_each()
+        Run commands one at a time, saving the output on the device
+    run_batch()
+        Run all commands on the device in a single round trip
+    stream_logs()
+        Capture command output over NETCONF, into a local archive
+    upload_ftp()
+        Upload a file from this host to the FTP server
 
 Exceptions:
 
@@ -26,9 +51,23 @@ Exceptions:
 
 Misc Variables:
 
-    commands : list
-        A list of show and request commands
-        This is used when colleting extensive logs
+    EXTENSIVE_DIR : str
+        The directory on the device to save extensive logs to
+    BATCH_SCRIPT : str
+        The script on the device used to batch extensive commands
+        (a template, filled in with the hostname and a timestamp)
+    BATCH_TIMEOUT : int
+        How long to wait for the batch script to finish (seconds)
+    LOG_INDEX : str
+        The file (on this host) that records which logs were collected
+    ARCHIVE_LIST : str
+        The file (on the device) that lists logs to archive
+        (a template, filled in with the hostname and a timestamp)
+
+Config:
+
+    The commands used for extensive logs are in the 'profiles' section
+        of junos-config.yaml
 
 Limitations:
     Requires NetConf to be enabled on the target device
@@ -40,181 +79,46 @@ Author:
 
 
 import datetime
+import ftplib
+import io
+import json
+import os
+import re
+import tarfile
+import tempfile
 import termcolor
 import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from plugins.junos import credentials
+from plugins.junos import facts
 from plugins.junos import netconf
-import jnpr.junos.exception
+from plugins.junos.progress import Progress
+from plugins.junos.settings import plugin_setting
 
 from core import teamschat
-from core import crypto
 from config import plugin_list
 
 
-# A list of commands to run
-#   Used when getting extensive logs
-commands = [
-    ('request pfe execute command '
-        '"show arena" target fwdd'),
-    'show system storage',
-    'show system virtual-memory',
-    'show system processes extensive',
-    'show security idp memory',
-    'show chassis routing-engine',
-    'show system processes extensive',
-    'show services application-identification counter',
-    'show security idp counters ips',
-    'show security idp counters memory',
-    'show security idp counters packet',
-    'show security idp counters flow',
-    'show security idp counters tcp-reassembler',
-    'show security idp application-statistics',
-    'show security flow session summary',
-    'show security resource-manager summary',
-    'show security resource-manager resource active',
-    'show security resource-manager group active',
-    'show services application-identification counter',
-    'show services application-identification statistics applications',
-    ('request pfe execute command '
-        '"show arena" target fwdd'),
-    ('request pfe execute command '
-        '"show memory" target fwdd'),
-    ('request pfe execute command '
-        '"show heap 0" target fwdd'),
-    ('request pfe execute command '
-        '"show heap 1" target fwdd'),
-    ('request pfe execute command '
-        '"show heap" target fwdd'),
-    ('request pfe execute command '
-        '"show heap 0 sanity" target fwdd'),
-    ('request pfe execute command '
-        '"show heap 0 accounting pc" target fwdd'),
-    ('request pfe execute command '
-        '"show heap 0 accounting pc size" target fwdd'),
-    ('request pfe execute command '
-        '"show heap 1 accounting pc size" target fwdd'),
-    ('request pfe execute command '
-        '"show usp memory segment shm control objcache jsf summary" '
-        'target fwdd'),
-    ('request pfe execute command '
-        '"show usp memory segment shm data objcache jsf summary" '
-        'target fwdd'),
-    ('request pfe execute command '
-        '"show usp memory segment shm data module" target fwdd'),
-    ('request pfe execute command '
-        '"show usp memory-use all" target fwdd'),
-    ('request pfe execute command '
-        '"show usp memory segment" target fwdd'),
-    ('request pfe execute command '
-        '"show usp memory segment shm" target fwdd'),
-    ('request pfe execute command '
-        '"show usp memory segment shm control module" target fwdd'),
-    ('request pfe execute command '
-        '"show usp memory segment shm control objcache jsf" target fwdd'),
-    ('request pfe execute command '
-        '"show usp memory segment shm data module" target fwdd'),
-    ('request pfe execute command '
-        '"show usp memory segment heap 0" target fwdd'),
-    ('request pfe execute command '
-        '"show usp memory segment shm data objcache service" target fwdd'),
-    ('request pfe execute command '
-        '"show usp memory segment shm data objcache jsf" target fwdd'),
-    ('request pfe execute command '
-        '"show usp memory segment heap modules" target fwdd'),
-    ('request pfe execute command '
-        '"show usp memory segment detail" target fwdd'),
-    ('request pfe execute command '
-        '"show usp idp status" target fwdd'),
-    ('request pfe execute command '
-        '"show usp idp context stats" target fwdd'),
-    ('request pfe execute command '
-        '"show usp idp context hits" target fwdd'),
-    ('request pfe execute command '
-        '"show usp idp memdebug" target fwdd'),
-    ('request pfe execute command '
-        '"show usp idp memory" target fwdd'),
-    ('request pfe execute command '
-        '"show usp idp debug-counter action" target fwdd'),
-    ('request pfe execute command '
-        '"show usp idp debug-counter memory" target fwdd'),
-    ('request pfe execute command '
-        '"show usp algs ftp stats" target fwdd'),
-    ('request pfe execute command '
-        '"show usp asl stats all" target fwdd'),
-    ('request pfe execute command '
-        '"show usp jsf tcp stats" target fwdd'),
-    ('request pfe execute command '
-        '"show usp jsf counters" target fwdd'),
-    ('request pfe execute command '
-        '"show usp jsf counters junos-alg" target fwdd'),
-    ('request pfe execute command '
-        '"show usp jsf flow stats" target fwdd'),
-    ('request pfe execute command '
-        '"show usp jsf jbuf_pool stats" target fwdd'),
-    ('request pfe execute command '
-        '"show usp jsf plugin-list" target fwdd'),
-    ('request pfe execute command '
-        '"show usp jsf plugins" target fwdd'),
-    ('request pfe execute command '
-        '"show usp flow session summary" target fwdd'),
-    ('request pfe execute command '
-        '"show usp flow counters all" target fwdd'),
-    ('request pfe execute command '
-        '"show usp flow stats" target fwdd'),
-    ('request pfe execute command '
-        '"show usp flow counter all" target fwdd'),
-    ('request pfe execute command '
-        '"show usp gate all" target fwdd'),
-    ('request pfe execute command '
-        '"show usp gate statistics" target fwdd'),
-    ('request pfe execute command '
-        '"show usp appfw statistic" target fwdd'),
-    ('request pfe execute command '
-        '"show usp appfw counter" target fwdd'),
-    ('request pfe execute command '
-        '"show usp appid config" target fwdd'),
-    ('request pfe execute command '
-        '"show usp appid thread status" target fwdd'),
-    ('request pfe execute command '
-        '"show usp plugins" target fwdd'),
-    ('request pfe execute command '
-        '"show piles" target fwdd'),
-    ('request pfe execute command '
-        '"show mbuf host" target fwdd'),
-    ('request pfe execute command '
-        '"show mbuf counters" target fwdd'),
-    ('request pfe execute command '
-        '"show service objcache" target fwdd'),
-    ('request pfe execute command '
-        '"plugin jdpi show configuration tunables" target fwdd'),
-    ('request pfe execute command '
-        '"show jsf shm module" target fwdd'),
-    ('request pfe execute command '
-        '"show jsf objcache" target fwdd'),
-    ('request pfe execute command '
-        '"show jsf shm module" target fwdd'),
-    ('request pfe execute command '
-        '"show jsf objcache" target fwdd'),
-    ('request pfe execute command '
-        '"show usp jsf counters" target fwdd'),
-    ('request pfe execute command '
-        '"show usp flow counters all" target fwdd'),
-    ('request pfe execute command '
-        '"show service objcache" target fwdd'),
-    ('request pfe execute command '
-        '"show jsf objcache" target fwdd'),
-    ('request pfe execute command '
-        '"show usp memory segment detail" target fwdd'),
-    ('request pfe execute command '
-        '"show usp memory segment shm data objcache services" target fwdd'),
-    ('request pfe execute command '
-        '"show usp memory segment shm data objcache jsf" target fwdd'),
-    ('request pfe execute command '
-        '"show piles" target fwdd'),
-    ('request pfe execute command '
-        '"show usp jsf jbuf_pool stats" target fwdd'),
-    ('request pfe execute command '
-        '"show usp memory segment shm data module" target fwdd')
-]
+# Where extensive logs are saved on the device
+EXTENSIVE_DIR = '/var/log/extensive'
+
+# The script used to run batched commands, and how long to wait for it
+#   Files on the device are named for the host and time (see device_file()),
+#   so collections running at once don't overwrite each other's files
+BATCH_SCRIPT = '/var/tmp/extensive_batch-{hostname}-{stamp}.sh'
+BATCH_TIMEOUT = 1800
+
+# Files used for incremental log archives
+#   The index (on this host) records which logs were collected
+#   The list (on the device) is the files to archive
+LOG_INDEX = 'log_index.json'
+ARCHIVE_LIST = '/var/tmp/archive_list-{hostname}-{stamp}.txt'
+_index_lock = threading.Lock()
+
+# The shared worker pool for log collection, and per-site limits
+_executor = None
+_site_slots = {}
+_pool_lock = threading.Lock()
 
 
 def get_logs(chat_id, **kwargs):
@@ -225,7 +129,7 @@ def get_logs(chat_id, **kwargs):
         chat_id : str
             The chat ID to report back to
         kwargs['ents'] : list
-            A list of NLP entities
+            A list of NLP entities (one or more devices)
         kwargs['message'] : str
             The original message the user sent
 
@@ -233,46 +137,282 @@ def get_logs(chat_id, **kwargs):
         None
     '''
 
-    # Look through kwargs to find a device name
-    #   This should have an NLP entity of 'DEVICE' assigned
-    device = ''
+    # Look through kwargs to find device names
+    #   These should have an NLP entity of 'DEVICE' assigned
+    device_list = []
     if 'ents' in kwargs:
         for ent in kwargs['ents']:
-            if ent['label'] == "DEVICE":
-                device = ent['ent']
-                break
+            if ent['label'] == "DEVICE" and ent['ent'] not in device_list:
+                device_list.append(ent['ent'])
 
-    # If we have a valid device name:
-    if device != '':
+    # If there's no valid device name, we can't proceed
+    if len(device_list) == 0:
         teamschat.send_chat(
-            f"I'll get the logs for {device}. Give me a few minutes",
+            "Sorry. you'll need to give me a device name",
             chat_id
         )
+        return
+
+    # All devices report progress through one object,
+    #   so updates are coalesced into as few messages as possible
+    progress = Progress(chat_id)
+    progress.update(
+        f"I'll get the logs for {', '.join(device_list)}. \
+            Give me a few minutes"
+    )
 
-        # If we need extensive logging
-        if 'extensive' in kwargs['message']:
-            thread = threading.Thread(
-                target=extensive_logs,
-                args=(device, chat_id,)
-            )
+    # If we need extensive logging
+    if 'extensive' in kwargs['message']:
+        job = extensive_logs
+        job_args = (get_commands(kwargs['message']),)
 
-        # Regular logging
-        else:
-            thread = threading.Thread(
-                target=get_rsi,
-                args=(device, chat_id,)
+    # Regular logging
+    #   Only changed logs are archived, unless 'full' logs are requested
+    else:
+        job = get_rsi
+        job_args = ('full' in kwargs['message'],)
+
+    # Collect from all devices in the background
+    thread = threading.Thread(
+        target=collect_logs,
+        args=(device_list, job, job_args, progress,)
+    )
+    thread.start()
+
+
+def device_site(device):
+    '''
+    Get the site a device belongs to
+
+    The site is the start of the device name, up to the 'site_delimiter'
+
+    Parameters:
+        device : str
+            The device name
+
+    Returns:
+        : str
+            The site name
+    '''
+
+    delimiter = plugin_setting('site_delimiter', '-')
+    return device.lower().split(delimiter, 1)[0]
+
+
+def site_slot(site):
+    '''
+    Get the semaphore that limits concurrent collections at a site
+
+    Parameters:
+        site : str
+            The site name
+
+    Returns:
+        : threading.Semaphore
+            The semaphore for this site
+    '''
+
+    with _pool_lock:
+        if site not in _site_slots:
+            _site_slots[site] = threading.Semaphore(
+                plugin_setting('log_site_workers', 2)
             )
+        return _site_slots[site]
+
+
+def run_job(device, job, job_args, progress):
+    '''
+    Run a log collection job
+
+    The caller holds the site's slot, which is released when the job ends
+
+    Parameters:
+        device : str
+            The device to collect logs from
+        job : function
+            The collection function (get_rsi or extensive_logs)
+        job_args : tuple
+            Arguments to pass to the job, after the device and progress
+        progress : progress.Progress
+            Reports progress back to the user
+
+    Returns:
+        True : bool
+            If successful
+        False : bool
+            If there was a problem
+    '''
+
+    try:
+        return job(device, progress, *job_args)
+    except Exception as err:
+        print(termcolor.colored(
+            f"Log collection failed for {device}: {err}",
+            "red"
+        ))
+        return False
+
+
+def submit_site(site, device_list, job, job_args, progress, executor,
+                futures):
+    '''
+    Submit the jobs for one site to the shared pool, as site slots free up
+
+    The site slot is taken before the job is submitted, so a job that is
+        waiting for its site never holds one of the shared workers
+    The slot is released when the job finishes
+
+    Parameters:
+        site : str
+            The site name
+        device_list : list
+            The devices at this site
+        job : function
+            The collection function (get_rsi or extensive_logs)
+        job_args : tuple
+            Arguments to pass to the job, after the device and progress
+        progress : progress.Progress
+            Reports progress back to the user
+        executor : concurrent.futures.ThreadPoolExecutor
+            The shared worker pool
+        futures : dict
+            Each submitted job is added, as {future: device}
+
+    Returns:
+        None
+    '''
 
-        # Start the thread
+    slot = site_slot(site)
+    for device in device_list:
+        slot.acquire()
+        future = executor.submit(run_job, device, job, job_args, progress)
+        future.add_done_callback(lambda _: slot.release())
+        futures[future] = device
+
+
+def collect_logs(device_list, job, job_args, progress):
+    '''
+    Collect logs from many devices, with bounded concurrency
+
+    Jobs run in a shared worker pool, so the number of collections
+        is limited across all requests ('log_workers'), and at each
+        site ('log_site_workers')
+    Each site has its own thread that waits for site slots, and only
+        then submits jobs to the pool
+    A summary is sent with the last updates, when all devices are finished
+
+    Parameters:
+        device_list : list
+            The devices to collect logs from
+        job : function
+            The collection function (get_rsi or extensive_logs)
+        job_args : tuple
+            Arguments to pass to the job, after the device and progress
+        progress : progress.Progress
+            Reports progress back to the user
+
+    Returns:
+        None
+    '''
+
+    global _executor
+
+    # The worker pool is shared, and created on first use
+    with _pool_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=plugin_setting('log_workers', 4),
+                thread_name_prefix='junos-logs'
+            )
+        executor = _executor
+
+    # Group the devices by site
+    sites = {}
+    for device in device_list:
+        sites.setdefault(device_site(device), []).append(device)
+
+    # Submit each site's jobs as its slots free up
+    futures = {}
+    submitters = [
+        threading.Thread(
+            target=submit_site,
+            args=(site, devices, job, job_args, progress, executor, futures,)
+        )
+        for site, devices in sites.items()
+    ]
+    for thread in submitters:
         thread.start()
+    for thread in submitters:
+        thread.join()
+
+    succeeded = []
+    failed = []
+    for future in as_completed(futures):
+        if future.result():
+            succeeded.append(futures[future])
+        else:
+            failed.append(futures[future])
 
-    # If there's no valid device name, we can't proceed
-    else:
-        teamschat.send_chat(
-            "Sorry. you'll need to give me a device name",
-            chat_id
+    # A single device reports its own progress
+    if len(device_list) == 1:
+        progress.finish()
+        return
+
+    message = (
+        f"Log collection complete: {len(succeeded)} of "
+        f"{len(device_list)} devices succeeded"
+    )
+    if failed:
+        message += (
+            f"<br><span style=\"color:Red\">Failed: "
+            f"{', '.join(failed)}</span>"
         )
 
+    print(termcolor.colored(message, "green"))
+    progress.finish(message)
+
+
+def get_commands(message):
+    '''
+    Get the extensive commands to run, based on the users request
+
+    Any profile named in the message is collected
+    If no profiles are named, all profiles are collected
+
+    Parameters:
+        message : str
+            The original message the user sent
+
+    Returns:
+        : list
+            The commands to run, with no duplicates
+    '''
+
+    profiles = {}
+    for plugin in plugin_list:
+        if 'Junos' in plugin['name']:
+            profiles = plugin['handler'].profiles
+
+    # Find any profiles the user asked for
+    selected = [
+        name for name in profiles
+        if re.search(rf'\b{re.escape(name)}\b', message.lower())
+    ]
+    if not selected:
+        selected = list(profiles)
+
+    print(termcolor.colored(
+        f"Extensive log profiles: {', '.join(selected)}",
+        "green"
+    ))
+
+    # Combine the profiles, keeping the order and removing duplicates
+    command_list = []
+    for name in selected:
+        command_list.extend(profiles[name])
+
+    return list(dict.fromkeys(command_list))
+
 
 def get_ftp(chat_id):
     '''
@@ -289,6 +429,7 @@ def get_ftp(chat_id):
         : dict
             The full FTP path (including username/password)
             A simplified path (no username/password)
+            The server, directory, username and password
         False : bool
             If there was a problem
     '''
@@ -312,7 +453,7 @@ def get_ftp(chat_id):
         return False
 
     # Get passwords required to connect to the FTP server
-    ftp_secret = crypto.pw_decrypt(dev_type='server', device=ftp_server)
+    ftp_secret = credentials.get_secret('server', ftp_server)
 
     # If that didn't work, print an error and return
     if not ftp_secret:
@@ -328,22 +469,544 @@ def get_ftp(chat_id):
     ftp_url = f'ftp://{ftp_user}:{ftp_pass}@{ftp_server}/{ftp_dir}/'
     redacted = f'ftp://{ftp_server}/{ftp_dir}/'
 
-    return {'full_path': ftp_url, 'redacted_path': redacted}
+    return {
+        'full_path': ftp_url,
+        'redacted_path': redacted,
+        'server': ftp_server,
+        'directory': ftp_dir,
+        'user': ftp_user,
+        'password': ftp_pass
+    }
+
+
+def device_file(template, hostname):
+    '''
+    Build the name of a temporary file on the device
+
+    Parameters:
+        template : str
+            BATCH_SCRIPT or ARCHIVE_LIST
+        hostname : str
+            The device's hostname
+
+    Returns:
+        : str
+            The full path of the file
+    '''
+
+    stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    return template.format(hostname=hostname, stamp=stamp)
+
+
+def command_filename(command, directory):
+    '''
+    Build a filename to save a command's output to
+
+    Parameters:
+        command : str
+            The junos command
+        directory : str
+            The directory on the device to save the file in
+
+    Returns:
+        : str
+            The full path of the file
+    '''
+
+    tidy_command = command.replace("\"", "")
+    tidy_command = tidy_command.replace(" ", "_")
+    return f'{directory}/{tidy_command}.txt'
+
+
+def run_each(shell, command_list, directory):
+    '''
+    Run commands one at a time, saving each output to a file on the device
+
+    Parameters:
+        shell : netconf.ShellSession
+            The shell session to run the commands in
+        command_list : list
+            The commands to run
+        directory : str
+            The directory on the device to save files to
+
+    Returns:
+        : list
+            A dictionary for each command, with 'command' and 'ok' keys
+        err : Exception
+            If the device could not be reached
+    '''
+
+    # Create a new directory for the logs to go in
+    shell.run(f'file delete-directory {directory} recurse')
+    shell.run(f'file make-directory {directory}')
+
+    status = []
+    for command in command_list:
+        filename = command_filename(command, directory)
+
+        # Run the command, and write the results to the filename
+        result = shell.run(f'{command} | save {filename}')
+        if not isinstance(result, str):
+            return result
+
+        status.append({'command': command, 'ok': 'Wrote' in result})
+
+    return status
+
+
+def run_batch(dev, shell, command_list, directory, hostname):
+    '''
+    Run all commands on the device in a single round trip
+
+    (1) Build a shell script that runs each command, and saves the output
+    (2) Copy the script to the device
+    (3) Run the script, and parse the status of each command
+
+    Parameters:
+        dev : jnpr.junos.device.Device
+            The device to run the commands on
+        shell : netconf.ShellSession
+            The shell session to run the script in
+        command_list : list
+            The commands to run
+        directory : str
+            The directory on the device to save files to
+        hostname : str
+            The device's hostname, used to name the script
+
+    Returns:
+        : list
+            A dictionary for each command, with 'command' and 'ok' keys
+        err : Exception
+            If the script could not be copied to the device or run
+    '''
+
+    batch_script = device_file(BATCH_SCRIPT, hostname)
+
+    # Each command reports a status line when it completes
+    #   'cli ... | save' prints 'Wrote N lines' when it succeeds
+    script = [
+        '#!/bin/sh',
+        'run() {',
+        '    out=$(cli -c "$2" 2>&1)',
+        '    case "$out" in',
+        '        *Wrote*) echo "BATCH|$1|ok" ;;',
+        '        *) echo "BATCH|$1|failed" ;;',
+        '    esac',
+        '}',
+        f"cli -c 'file delete-directory {directory} recurse' >/dev/null 2>&1",
+        f"cli -c 'file make-directory {directory}' >/dev/null 2>&1",
+    ]
+
+    for index, command in enumerate(command_list):
+        filename = command_filename(command, directory)
+        line = f'{command} | save {filename}'.replace("'", "'\\''")
+        script.append(f"run {index} '{line}'")
+
+    script.append(f'rm -f {batch_script}')
+
+    # Write the script locally, and copy it to the device
+    with tempfile.NamedTemporaryFile(
+        mode='w', suffix='.sh', delete=False
+    ) as local:
+        local.write('\n'.join(script) + '\n')
+
+    try:
+        result = netconf.put_file(dev, local.name, batch_script)
+    finally:
+        os.remove(local.name)
+
+    if result is not True:
+        return result
+
+    # Run the script in one go
+    print(termcolor.colored(
+        f"Running {len(command_list)} commands as a batch",
+        "yellow"
+    ))
+    result = shell.run_shell(f'sh {batch_script}', timeout=BATCH_TIMEOUT)
+    if not isinstance(result, str):
+        return result
+
+    # Collect the status for each command
+    ok = {}
+    for line in result.splitlines():
+        line = line.strip()
+        if line.startswith('BATCH|'):
+            _, index, outcome = line.split('|', 2)
+            ok[int(index)] = outcome == 'ok'
+
+    return [
+        {'command': command, 'ok': ok.get(index, False)}
+        for index, command in enumerate(command_list)
+    ]
+
+
+def upload_ftp(local_path, chat_id):
+    '''
+    Upload a file from this host to the FTP server
+
+    Parameters:
+        local_path : str
+            The file to upload
+        chat_id : str
+            The chat ID to report back to
+
+    Returns:
+        : str
+            The location of the file on the FTP server (no credentials)
+        False : bool
+            If there was a problem
+    '''
+
+    ftp = get_ftp(chat_id)
+    if not ftp:
+        return False
+
+    filename = os.path.basename(local_path)
+    try:
+        with ftplib.FTP(ftp['server']) as session:
+            session.login(ftp['user'], ftp['password'])
+            session.cwd(ftp['directory'])
+            with open(local_path, 'rb') as upload:
+                session.storbinary(f'STOR {filename}', upload)
+    except ftplib.all_errors as err:
+        print(termcolor.colored(f"FTP upload failed: {err}", "red"))
+
+        # A failed login means the cached password may be out of date
+        if str(err).startswith('530'):
+            credentials.invalidate('server', ftp['server'])
+
+        teamschat.send_chat(
+            f"I couldn't upload to FTP. The logs are on my host at \
+                <span style=\"color:Yellow\">{local_path}</span>",
+            chat_id
+        )
+        return False
+
+    return f"{ftp['redacted_path']}{filename}"
+
+
+def stream_logs(dev, host, command_list, archive, progress):
+    '''
+    Capture command output over NETCONF, into a local archive
+
+    Each output is added to the archive as soon as it arrives,
+        so only one output is held in memory at a time
+    Nothing is written to the device's storage
+    The local archive is removed once it's uploaded,
+        and kept if the upload fails, so it can be sent by hand
 
+    Parameters:
+        dev : jnpr.junos.device.Device
+            The device to run the commands on
+        host : str
+            The device name, for progress updates
+        command_list : list
+            The commands to run
+        archive : str
+            The name of the archive to create
+        progress : progress.Progress
+            Reports progress back to the user
+
+    Returns:
+        True : bool
+            If successful
+        False : bool
+            If there was a problem
+    '''
+
+    local_dir = plugin_setting('local_log_dir', tempfile.gettempdir())
+    os.makedirs(local_dir, exist_ok=True)
+    local_path = os.path.join(local_dir, archive)
+
+    failed = []
+    with tarfile.open(local_path, 'w:gz') as tar:
+        for command in command_list:
+            print(termcolor.colored(command, "yellow"))
+            try:
+                output = dev.cli(command, format='text', warning=False)
+            except Exception as err:
+                print(termcolor.colored(
+                    f"Could not run {command}: {err}",
+                    "red"
+                ))
+                failed.append(command)
+                continue
+
+            # Add the output to the archive
+            data = str(output).encode()
+            info = tarfile.TarInfo(
+                os.path.basename(command_filename(command, 'extensive'))
+            )
+            info.size = len(data)
+            info.mtime = int(datetime.datetime.now().timestamp())
+            tar.addfile(info, io.BytesIO(data))
+
+    progress.update(
+        f"Collected {len(command_list) - len(failed)} of \
+            {len(command_list)} show commands",
+        host
+    )
+
+    # Upload the archive to an FTP server
+    ftp_file = upload_ftp(local_path, progress.chat_id)
+    if not ftp_file:
+        print(termcolor.colored(
+            f"The archive has been kept at {local_path}",
+            "red"
+        ))
+        return False
+
+    # The archive is on the FTP server, so the local copy isn't needed
+    try:
+        os.remove(local_path)
+    except OSError as err:
+        print(termcolor.colored(
+            f"Could not remove {local_path}: {err}",
+            "red"
+        ))
+
+    print(termcolor.colored(f"Extensive logs are at {ftp_file}", "green"))
+    progress.update(f"You can find your logs at {ftp_file}", host)
+
+    return True
+
+
+def list_logs(dev):
+    '''
+    Get the size and modification time of each file in /var/log
+
+    Subdirectories are listed too, so their files can be archived
+        when they change
+
+    Parameters:
+        dev : jnpr.junos.device.Device
+            The device to check
+
+    Returns:
+        : dict
+            {path: [size, mtime]}, with paths relative to /var/log
+        None
+            If the file list could not be read
+    '''
+
+    try:
+        result = dev.rpc.file_list(
+            detail=True,
+            recursive=True,
+            path='/var/log/'
+        )
+    except Exception as err:
+        print(termcolor.colored(f"Could not list log files: {err}", "red"))
+        return None
+
+    # Each directory is listed separately, with its own files
+    directories = result.findall('.//directory') or [result]
+
+    files = {}
+    for directory in directories:
+        directory_name = directory.findtext('directory-name', '/var/log/')
+        for item in directory.findall('file-information'):
+            # Skip directories, as their files are listed separately
+            if item.find('file-directory') is not None:
+                continue
+
+            name = item.findtext('file-name', '').strip()
+            if name == '':
+                continue
+
+            # Index the file by its path, relative to /var/log
+            path = os.path.join(directory_name.strip(), name)
+            path = os.path.relpath(os.path.normpath(path), '/var/log')
+            if path.startswith('..'):
+                continue
+
+            files[path] = [
+                item.findtext('file-size', '').strip(),
+                item.findtext('file-date', '').strip()
+            ]
+
+    return files
+
+
+def changed_logs(hostname, log_files):
+    '''
+    Compare log files to the index from the last collection
+
+    Parameters:
+        hostname : str
+            The device's hostname
+        log_files : dict
+            The current files, from list_logs()
+
+    Returns:
+        : list
+            Files that are new, or have changed
+        None
+            If this device has not been collected from before
+    '''
+
+    with _index_lock:
+        index = load_index()
+
+    previous = index.get(hostname)
+    if previous is None:
+        return None
+
+    return [
+        name for name, details in log_files.items()
+        if previous.get(name) != details
+    ]
+
+
+def load_index():
+    '''
+    Load the index of previously collected log files
 
-def get_rsi(host, chat_id):
+    Returns:
+        : dict
+            {hostname: {filename: [size, mtime]}}
+    '''
+
+    try:
+        with open(index_path()) as index_file:
+            return json.load(index_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_index(hostname, log_files):
+    '''
+    Save the log files that were collected from a device
+
+    Parameters:
+        hostname : str
+            The device's hostname
+        log_files : dict
+            The files that were collected, from list_logs()
+
+    Returns:
+        None
+    '''
+
+    with _index_lock:
+        index = load_index()
+        index[hostname] = log_files
+
+        # Write to a temporary file first, so the index is never half-written
+        path = index_path()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(f'{path}.tmp', 'w') as index_file:
+            json.dump(index, index_file)
+        os.replace(f'{path}.tmp', path)
+
+
+def index_path():
+    '''
+    Get the location of the log index file on this host
+
+    Returns:
+        : str
+            The path to the index file
+    '''
+
+    local_dir = plugin_setting('local_log_dir', tempfile.gettempdir())
+    return os.path.join(local_dir, LOG_INDEX)
+
+
+def archive_files(dev, shell, file_list, log_filename, hostname):
+    '''
+    Archive a list of files from /var/log on the device
+
+    The file list is copied to the device, and passed to tar
+
+    Parameters:
+        dev : jnpr.junos.device.Device
+            The device to archive files on
+        shell : netconf.ShellSession
+            The shell session to run tar in
+        file_list : list
+            The files to archive, relative to /var/log
+        log_filename : str
+            The archive to create
+        hostname : str
+            The device's hostname, used to name the file list
+
+    Returns:
+        : str
+            The output of tar
+        err : Exception
+            If there was a problem, including tar failing
+    '''
+
+    with tempfile.NamedTemporaryFile(
+        mode='w', suffix='.txt', delete=False
+    ) as local:
+        local.write('\n'.join(file_list) + '\n')
+
+    archive_list = device_file(ARCHIVE_LIST, hostname)
+    try:
+        result = netconf.put_file(dev, local.name, archive_list)
+    finally:
+        os.remove(local.name)
+
+    if result is not True:
+        return result
+
+    # A status line is printed if tar succeeds
+    result = shell.run_shell(
+        f'tar -czf {log_filename} -C /var/log -T {archive_list} '
+        f'&& echo ARCHIVE_OK; rm -f {archive_list}'
+    )
+    if not isinstance(result, str):
+        return result
+
+    lines = [line.strip() for line in result.splitlines()]
+    if 'ARCHIVE_OK' not in lines:
+        print(termcolor.colored(f"tar failed: {result}", "red"))
+        return RuntimeError(f"Could not create {log_filename}: {result}")
+
+    return '\n'.join(line for line in lines if line != 'ARCHIVE_OK')
+
+
+def device_error(err, dev, progress):
+    '''
+    Report a device error, after sending any held progress updates
+
+    Parameters:
+        err : Exception or str
+            The error to report
+        dev : jnpr.junos.device.Device
+            The device that had the error
+        progress : progress.Progress
+            Reports progress back to the user
+
+    Returns:
+        None
+    '''
+
+    progress.flush()
+    netconf.error_handler(err=err, dev=dev, chat_id=progress.chat_id)
+
+
+def get_rsi(host, progress, full=False):
     '''
     Connect to a junos device and get the logs
 
     (1) Generate the RSI
     (2) Compress logs to an archive
+        Only logs that changed since the last collection are included
     (3) Upload to an FTP server
 
         Parameters:
             host : str
                 The hostname to connect to
-            chat_id : str
-                The chat ID to report back to
+            progress : progress.Progress
+                Reports progress back to the user
+            full : bool
+                Archive all logs, even if they were collected before
 
         Returns:
             True : bool
@@ -353,111 +1016,137 @@ def get_rsi(host, chat_id):
     '''
 
     # Get passwords required to connect to the device
-    secret = crypto.pw_decrypt(dev_type='junos', device=host)
+    secret = credentials.get_secret('junos', host)
     if not secret:
-        teamschat.send_chat(
-            f"I couldn't get a password to connect to {host}",
-            chat_id
-        )
+        progress.update(f"I couldn't get a password to connect to {host}")
         return False
 
     # Connect to the Junos device; Should return a connection object
     # If the returned object is not right, handle the error
-    dev = netconf.junos_connect(host, secret['user'], secret['password'])
-    if not isinstance(dev, jnpr.junos.device.Device):
-        netconf.error_handler(err=dev, dev=dev, chat_id=chat_id)
-        return False
-
-    # Get extra details for filenames
-    hostname = dev.facts['hostname']
-    date = str(datetime.date.today())
-    time = str(datetime.datetime.now().strftime("%H%M"))
-    rsi_filename = f'/var/log/RSI-Support-{hostname}-{date}-{time}.txt'
-    print(termcolor.colored(f'RSI filename: {rsi_filename}', 'green'))
-
-    # Generate the RSI
-    result = netconf.send_shell(
-        f'request support information | save {rsi_filename}',
-        dev
+    dev = netconf.junos_connect(
+        host,
+        secret['user'],
+        secret['password'],
+        facts=False
     )
-
-    if not isinstance(result, str):
-        netconf.error_handler(err=result, dev=dev, chat_id=chat_id)
+    if not netconf.is_device(dev):
+        if credentials.is_auth_error(dev):
+            credentials.invalidate('junos', host)
+        device_error(dev, dev, progress)
         return False
 
-    teamschat.send_chat(
-        f"I've created the RSI<br> \
-            <span style=\"color:Yellow\">{rsi_filename}</span>",
-        chat_id
-    )
-
-    # Create an archive of logs
-    log_filename = f'/var/tmp/Support-{hostname}-{date}-{time}.tgz'
-    print(termcolor.colored(f'Archive filename: {log_filename}', 'green'))
-
-    result = netconf.send_shell(
-        f'file archive compress source /var/log/* destination {log_filename}',
-        dev
-    )
-
-    if not isinstance(result, str):
-        netconf.error_handler(err=result, dev=dev, chat_id=chat_id)
-        return False
-
-    print(termcolor.colored(f"Device responded: {result}", "green"))
-
-    teamschat.send_chat(
-        f"I've created the log archive<br> \
-            <span style=\"color:Yellow\">{log_filename}</span>",
-        chat_id
-    )
-
-    # Upload the archive to an FTP server
-    ftp = get_ftp(chat_id)
-
-    # Check for a valid result, and build filenames
-    if ftp:
-        ftp_url = ftp['full_path']
-        ftp_server = ftp['redacted_path']
-        ftp_file = f'{ftp_server}Support-{hostname}-{date}-{time}.tgz'
+    # The session is always returned to the pool, even if there's an error
+    #   The shell channel is closed first, when the 'with' block ends
+    try:
+        # Get extra details for filenames
+        #   The hostname comes from the facts cache, if it's there
+        device_facts = facts.get_facts(host, dev)
+        hostname = device_facts['hostname'] if device_facts else host
+        date = str(datetime.date.today())
+        time = str(datetime.datetime.now().strftime("%H%M"))
+        rsi_filename = f'/var/log/RSI-Support-{hostname}-{date}-{time}.txt'
+        print(termcolor.colored(f'RSI filename: {rsi_filename}', 'green'))
+
+        # Open one shell channel, and use it for all commands
+        with netconf.ShellSession(dev) as shell:
+            # Generate the RSI
+            result = shell.run(
+                f'request support information | save {rsi_filename}'
+            )
 
-    else:
-        return False
+            if not isinstance(result, str):
+                device_error(result, dev, progress)
+                return False
 
-    # Inform the user
-    print(termcolor.colored(f'Uploading to {ftp_url}', 'green'))
-    teamschat.send_chat(
-        "I'm uploading the archive now...",
-        chat_id
-    )
+            progress.update(
+                f"I've created the RSI<br> \
+                    <span style=\"color:Yellow\">{rsi_filename}</span>",
+                host
+            )
 
-    # Copy the archive to FTP
-    #   Sometimes the junos device mangles this string,
-    #   so it should be manually encoded as ASCII
-    result = netconf.send_shell(
-        (
-            f'file copy {log_filename} {ftp_url}'
-        ),
-        dev
-    )
-    print(termcolor.colored(f"FTP result: {result}", "cyan"))
+            # Create an archive of logs
+            log_filename = f'/var/tmp/Support-{hostname}-{date}-{time}.tgz'
+            print(termcolor.colored(
+                f'Archive filename: {log_filename}',
+                'green'
+            ))
 
-    if 'not' in result.lower():
-        netconf.error_handler(err=result, dev=dev, chat_id=chat_id)
-        return False
+            # Find logs that have changed since the last collection
+            #   If there's no index (or 'full' is set), archive everything
+            log_files = list_logs(dev)
+            changed = None
+            if not full and log_files is not None:
+                changed = changed_logs(hostname, log_files)
+
+            if changed is None:
+                result = shell.run(
+                    'file archive compress source /var/log/* '
+                    f'destination {log_filename}'
+                )
+            else:
+                print(termcolor.colored(
+                    f'Archiving {len(changed)} of {len(log_files)} log files',
+                    'green'
+                ))
+                result = archive_files(
+                    dev, shell, changed, log_filename, hostname
+                )
+
+            if not isinstance(result, str):
+                device_error(result, dev, progress)
+                return False
+
+            print(termcolor.colored(f"Device responded: {result}", "green"))
+
+            progress.update(
+                f"I've created the log archive<br> \
+                    <span style=\"color:Yellow\">{log_filename}</span>",
+                host
+            )
 
-    # Gracefully close the device
-    teamschat.send_chat(
-        f"All done! The logs are here:<br> \
-            <span style=\"color:Yellow\">{ftp_file}</span>",
-        chat_id
-    )
-    dev.close()
+            # Upload the archive to an FTP server
+            ftp = get_ftp(progress.chat_id)
+
+            # Check for a valid result, and build filenames
+            if ftp:
+                ftp_url = ftp['full_path']
+                ftp_server = ftp['redacted_path']
+                ftp_file = f'{ftp_server}Support-{hostname}-{date}-{time}.tgz'
+
+            else:
+                return False
+
+            # Inform the user
+            print(termcolor.colored(f'Uploading to {ftp_url}', 'green'))
+            progress.update("I'm uploading the archive now...", host)
+
+            # Copy the archive to FTP
+            #   Sometimes the junos device mangles this string,
+            #   so it should be manually encoded as ASCII
+            result = shell.run(f'file copy {log_filename} {ftp_url}')
+            print(termcolor.colored(f"FTP result: {result}", "cyan"))
+
+            if not isinstance(result, str) or 'not' in result.lower():
+                device_error(result, dev, progress)
+                return False
+
+        # Remember what was collected, for next time
+        if log_files is not None:
+            save_index(hostname, log_files)
+
+        # Let the user know where the logs are
+        progress.update(
+            f"All done! The logs are here:<br> \
+                <span style=\"color:Yellow\">{ftp_file}</span>",
+            host
+        )
+        return True
 
-    return True
+    finally:
+        netconf.junos_release(dev)
 
 
-def extensive_logs(host, chat_id):
+def extensive_logs(host, progress, command_list):
     '''
     Connect to a junos device to get detailed logs
 
@@ -469,8 +1158,10 @@ def extensive_logs(host, chat_id):
     Parameters:
         host : str
             The hostname to connect to
-        chat_id : str
-            The chat ID to report back to
+        progress : progress.Progress
+            Reports progress back to the user
+        command_list : list
+            The show and request commands to collect
 
     Returns:
         True : bool
@@ -480,123 +1171,131 @@ def extensive_logs(host, chat_id):
     '''
 
     print(termcolor.colored("Getting extensive logs (20-25 minutes)", "green"))
-    teamschat.send_chat(
+    progress.update(
         ("Collecting extensive Junos logs. "
          "This many logs will take 20-25 minutes to collect"),
-        chat_id
+        host
     )
 
     # Get regular logs
-    get_rsi(host, chat_id)
+    get_rsi(host, progress)
 
     # Get passwords required to connect to the device
-    secret = crypto.pw_decrypt(dev_type='junos', device=host)
+    secret = credentials.get_secret('junos', host)
     if not secret:
-        teamschat.send_chat(
-            f"I couldn't get a password to connect to {host}",
-            chat_id
-        )
+        progress.update(f"I couldn't get a password to connect to {host}")
         return False
 
     # Connect to the Junos device; Should return a connection object
     # If the returned object is not right, handle the error
-    dev = netconf.junos_connect(host, secret['user'], secret['password'])
-    if not isinstance(dev, jnpr.junos.device.Device):
-        netconf.error_handler(err=dev, dev=dev, chat_id=chat_id)
-        return False
-
-    # Get extra details for filenames
-    hostname = dev.facts['hostname']
-    date = str(datetime.date.today())
-    time = str(datetime.datetime.now().strftime("%H%M"))
-
-    teamschat.send_chat(
-        "Now to get all the show commands...",
-        chat_id
-    )
-
-    # Create a new directory for the logs to go in
-    netconf.send_shell(
-        'file delete-directory /var/log/extensive recurse',
-        dev
-    )
-    netconf.send_shell(
-        'file make-directory /var/log/extensive',
-        dev
+    dev = netconf.junos_connect(
+        host,
+        secret['user'],
+        secret['password'],
+        facts=False
     )
+    if not netconf.is_device(dev):
+        if credentials.is_auth_error(dev):
+            credentials.invalidate('junos', host)
+        device_error(dev, dev, progress)
+        return False
 
-    # Generate a separate log file in /var/log/extensive for each command
-    #   The command is inserted into the filename
-    for command in commands:
-        tidy_command = command.replace("\"", "")
-        tidy_command = tidy_command.replace(" ", "_")
-        filename = f'/var/log/extensive/{tidy_command}.txt'
+    # The session is always returned to the pool, even if there's an error
+    #   The shell channel is closed first, when the 'with' block ends
+    try:
+        # Get extra details for filenames
+        #   The hostname comes from the facts cache, if it's there
+        device_facts = facts.get_facts(host, dev)
+        hostname = device_facts['hostname'] if device_facts else host
+        date = str(datetime.date.today())
+        time = str(datetime.datetime.now().strftime("%H%M"))
+
+        progress.update("Now to get all the show commands...", host)
+
+        # Stream mode captures output over NETCONF, into a local archive
+        #   This doesn't write to the device, or re-archive /var/log
+        if plugin_setting('extensive_capture', 'device') == 'stream':
+            archive = f'extensive_logs-{hostname}-{date}-{time}.tgz'
+            return stream_logs(dev, host, command_list, archive, progress)
+
+        # Open one shell channel, and use it for all commands
+        with netconf.ShellSession(dev) as shell:
+            # Generate a separate log file in /var/log/extensive per command
+            #   Batch mode runs them all on the device in one round trip
+            #   Fall back to one command at a time if that's not possible
+            status = None
+            if plugin_setting('extensive_batch', True):
+                status = run_batch(
+                    dev, shell, command_list, EXTENSIVE_DIR, hostname
+                )
+
+            if not isinstance(status, list):
+                status = run_each(shell, command_list, EXTENSIVE_DIR)
+
+            # Handle any errors
+            if not isinstance(status, list):
+                device_error(status, dev, progress)
+                return False
+
+            # Report back on any commands that didn't work
+            failed = [item['command'] for item in status if not item['ok']]
+            for command in failed:
+                print(termcolor.colored(
+                    f"Could not run {command} on {hostname}",
+                    "red"
+                ))
+
+            progress.update(
+                f"Collected {len(status) - len(failed)} of {len(status)} \
+                    show commands",
+                host
+            )
 
-        # Run the command, and write the results to the filename
-        try:
-            result = netconf.send_shell(f'{command} | save {filename}', dev)
-        except Exception as err:
+            # Create an archive of logs
+            log_filename = (
+                f'/var/tmp/extensive_logs-{hostname}-{date}-{time}.tgz'
+            )
             print(termcolor.colored(
-                f"Could not run {command} on {hostname}",
-                "red"
+                f'Archive filename: {log_filename}',
+                'green'
             ))
-            print(termcolor.colored(err, "red"))
+            progress.update(f"Archving logs to {log_filename}", host)
 
-        # Handle any errors
-        if not isinstance(result, str):
-            netconf.error_handler(err=result, dev=dev, chat_id=chat_id)
-            return False
-
-    # Create an archive of logs
-    log_filename = f'/var/tmp/extensive_logs-{hostname}-{date}-{time}.tgz'
-    print(termcolor.colored(f'Archive filename: {log_filename}', 'green'))
-    teamschat.send_chat(
-        f"Archving logs to {log_filename}",
-        chat_id
-    )
+            result = shell.run(
+                'file archive compress source /var/log/* '
+                f'destination {log_filename}'
+            )
 
-    result = netconf.send_shell(
-        f'file archive compress source /var/log/* destination {log_filename}',
-        dev
-    )
+            if not isinstance(result, str):
+                device_error(result, dev, progress)
+                return False
 
-    if not isinstance(result, str):
-        netconf.error_handler(err=result, dev=dev, chat_id=chat_id)
-        return False
+            # Upload the archive to an FTP server
+            ftp = get_ftp(progress.chat_id)
 
-    # Upload the archive to an FTP server
-    ftp = get_ftp(chat_id)
-
-    # Check for a valid result, and build filenames
-    if ftp:
-        ftp_url = ftp['full_path']
-        ftp_server = ftp['redacted_path']
-        ftp_file = f'{ftp_server}{log_filename}'
+            # Check for a valid result, and build filenames
+            if ftp:
+                ftp_url = ftp['full_path']
+                ftp_server = ftp['redacted_path']
+                ftp_file = f'{ftp_server}{log_filename}'
 
-    else:
-        return False
+            else:
+                return False
 
-    # Copy the archive to FTP
-    #   Sometimes the junos device mangles this string,
-    #   so it should be manually encoded as ASCII
-    result = netconf.send_shell(
-        (
-            f'{log_filename} {ftp_url}'
-        ),
-        dev
-    )
-    print(termcolor.colored(f"FTP result: {result}", "cyan"))
+            # Copy the archive to FTP
+            #   Sometimes the junos device mangles this string,
+            #   so it should be manually encoded as ASCII
+            result = shell.run(f'{log_filename} {ftp_url}')
+            print(termcolor.colored(f"FTP result: {result}", "cyan"))
 
-    if 'not' in result.lower():
-        netconf.error_handler(err=result, dev=dev, chat_id=chat_id)
-        return False
+            if not isinstance(result, str) or 'not' in result.lower():
+                device_error(result, dev, progress)
+                return False
 
-    # Gracefully close the device
-    print(termcolor.colored(f"Extensive logs are at {ftp_file}", "green"))
-    teamschat.send_chat(
-        f"You can find your logs at {ftp_file}",
-        chat_id
-    )
-    dev.close()
+        # Let the user know where the logs are
+        print(termcolor.colored(f"Extensive logs are at {ftp_file}", "green"))
+        progress.update(f"You can find your logs at {ftp_file}", host)
+        return True
 
-    return True
+    finally:
+        netconf.junos_release(dev)
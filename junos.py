@@ -7,8 +7,45 @@ Usage:
 
 Restrictions:
     Needs access to the 'teamschat' module
+    Requires the 'pyodbc' module (install with pip)
     Does not support subfilters, as some other plugins do
 
+Pipeline:
+    handle_event() puts the event on a bounded queue, and returns immediately
+    Chat workers assign a priority, and post to Teams
+    A SQL worker writes events to the database
+        Rows are buffered, and written as one parameterized insert,
+        every 'sql_batch_size' rows or 'sql_batch_ms' milliseconds
+        Buffered rows are written when the plugin shuts down
+    If the SQL queue is full, chat workers wait, so the event queue fills
+    If the event queue is full, new events are dropped (and counted)
+
+Suppression:
+    Repeats of an event (same host, event, and message) are counted
+    The first is sent, and a summary with the count is sent when the
+        window ends (eg, 'ROOT_PORT x37 ... in last 60s')
+    Windows are set per event in the 'suppression' section of the config
+
+Digest:
+    If 'digest_interval' is set, priority 2 events are buffered
+    Every interval, they are sent as one table, grouped by device and event
+    Priority 1 events are still sent immediately
+
+Authentication:
+    The agent signs the timestamp, a one-time nonce, and the body
+    verify_webhook() checks these before the body is parsed
+        Stale timestamps are rejected first, then the signature is
+        checked in constant time, then replayed nonces are rejected
+    Seen nonces are kept in a size-limited cache until they expire
+    These checks only apply if the core passes the raw request to
+        handle_webhook(); events the core has already parsed and passed to
+        handle_event() are only checked against the 'Junos-Auth' header
+
+Reloading:
+    The config and entities files are checked for changes every few seconds
+    Changed files are parsed and validated, then swapped in
+    If there is a problem, the old config is kept
+
 To Do:
     TBA
 
@@ -20,8 +57,22 @@ Author:
 # import yaml
 from core import teamschat
 from core import plugin
+from config import GLOBAL
+from plugins.junos.classifier import EventClassifier
+from plugins.junos import wire
+from collections import OrderedDict
 from datetime import datetime
+import atexit
+import hashlib
+import hmac
+import os
+import pickle
+import pyodbc
+import queue
+import re
 import termcolor
+import threading
+import time
 import yaml
 
 
@@ -29,14 +80,80 @@ import yaml
 LOCATION = 'plugins\\junos\\junos-config.yaml'
 ENTITIES = 'plugins\\junos\\entities.yaml'
 
+# How long a chat worker waits for space in the SQL queue (seconds)
+SQL_QUEUE_WAIT = 5
+
+# The columns written for each event, in order
+SQL_COLUMNS = (
+    'device',
+    'event',
+    'description',
+    'logdate',
+    'logtime',
+    'source',
+    'message'
+)
+
+# Put on the SQL queue to stop the SQL worker
+SQL_STOP = object()
+
+# How long (seconds) to wait for the SQL worker to finish, when stopping
+STOP_TIMEOUT = 10
+
+# Timestamps and counters, which are ignored when matching repeated events
+#   Numbers inside other tokens (ge-0/0/1, ae12, 10.0.0.1) are kept
+TIMESTAMP_REGEX = re.compile(
+    r'\b\d{4}-\d{2}-\d{2}\b|\b\d{1,2}:\d{2}(?::\d{2})?(?:\.\d+)?\b'
+)
+COUNTER_REGEX = re.compile(r'(?<![\w./:-])\d+(?:\.\d+)?(?![\w./:-])')
+
+
+# Load a YAML file
+#   A pickled copy is kept next to the file, and used if the file
+#   hasn't changed (same size and modification time), as this is
+#   much faster than parsing the YAML again
+def load_yaml(path):
+    stat = os.stat(path)
+    stamp = (stat.st_mtime, stat.st_size)
+    cache = f'{path}.cache'
+
+    try:
+        with open(cache, 'rb') as cache_file:
+            cached = pickle.load(cache_file)
+        if cached['stamp'] == stamp:
+            return cached['data']
+    except Exception:
+        pass
+
+    with open(path) as yaml_file:
+        data = yaml.load(yaml_file, Loader=yaml.FullLoader)
+
+    # Write the cache through a temporary file, so it's never half-written
+    try:
+        with open(f'{cache}.tmp', 'wb') as cache_file:
+            pickle.dump({'stamp': stamp, 'data': data}, cache_file)
+        os.replace(f'{cache}.tmp', cache)
+    except OSError as err:
+        print(termcolor.colored(f"Could not cache {path}: {err}", "red"))
+
+    return data
+
 
 # Junos handler class
 class JunosHandler(plugin.PluginTemplate):
     def __init__(self):
         super().__init__(LOCATION)
         self.table = self.config['config']['sql_table']
+
+        # The insert is the same for every event, so the server reuses the plan
+        self.sql_string = (
+            f"INSERT INTO {self.table} ({', '.join(SQL_COLUMNS)}) "
+            f"VALUES ({', '.join('?' for _ in SQL_COLUMNS)})"
+        )
         self.ftp_server = self.config['config']['ftp_server']
         self.ftp_dir = self.config['config']['ftp_dir']
+        self.profiles = self.load_profiles()
+        self.classifier = self.load_classifier()
         self.phrase_list = [
             {
                 "phrase": "juno log",
@@ -55,30 +172,444 @@ class JunosHandler(plugin.PluginTemplate):
             }
         ]
 
-        with open(ENTITIES) as config:
-            try:
-                self.entities = yaml.load(config, Loader=yaml.FullLoader)
-
-            # Handle problems with YAML syntax
-            except yaml.YAMLError as err:
-                print(f'Error parsing {ENTITIES}')
-                print('Check the YAML formatting at \
-                    https://yaml-online-parser.appspot.com/')
-                print(err)
+        # Queues and workers for the event pipeline
+        queue_size = self.config['config'].get('queue_size', 1000)
+        self.event_queue = queue.Queue(maxsize=queue_size)
+        self.sql_queue = queue.Queue(maxsize=queue_size)
+        self.stats = {
+            'received': 0,
+            'dropped': 0,
+            'sql_dropped': 0,
+            'processed': 0,
+            'written': 0,
+            'sql_failed': 0,
+            'suppressed': 0,
+            'rejected': 0,
+            'replayed': 0,
+            'max_depth': 0
+        }
+        self.nonces = OrderedDict()
+        self.nonce_lock = threading.Lock()
+        self.suppress_list = {}
+        self.suppress_lock = threading.Lock()
+        self.digest = []
+        self.digest_lock = threading.Lock()
+        self.digest_interval = self.config['config'].get('digest_interval', 0)
+        self.sql_conn = None
+        self.stopped = False
+        self.stats_lock = threading.Lock()
+        self.start_workers(self.config['config'].get('chat_workers', 2))
+        atexit.register(self.stop)
+
+        # Watch the config files for changes
+        self.mtimes = self.config_mtimes()
+        threading.Thread(
+            target=self.watch_worker,
+            name='junos-watch',
+            daemon=True
+        ).start()
+
+        try:
+            self.entities = load_yaml(ENTITIES)
+
+        # Handle problems with YAML syntax
+        except yaml.YAMLError as err:
+            print(f'Error parsing {ENTITIES}')
+            print('Check the YAML formatting at \
+                https://yaml-online-parser.appspot.com/')
+            print(err)
+            return False
+
+    # Load the extensive log command profiles from the config
+    #   Remove duplicate commands, keeping the original order
+    def load_profiles(self, config=None):
+        config = config or self.config
+        profiles = {}
+        raw_profiles = config.get('profiles') or {}
+
+        for name, command_list in raw_profiles.items():
+            profiles[name.lower()] = list(dict.fromkeys(command_list or []))
+
+        return profiles
+
+    # Start the worker threads for the event pipeline
+    def start_workers(self, chat_workers):
+        for number in range(chat_workers):
+            threading.Thread(
+                target=self.chat_worker,
+                name=f'junos-chat-{number}',
+                daemon=True
+            ).start()
+
+        self.sql_thread = threading.Thread(
+            target=self.sql_worker,
+            name='junos-sql',
+            daemon=True
+        )
+        self.sql_thread.start()
+
+        threading.Thread(
+            target=self.suppress_worker,
+            name='junos-suppress',
+            daemon=True
+        ).start()
+
+        if self.digest_interval > 0:
+            threading.Thread(
+                target=self.digest_worker,
+                name='junos-digest',
+                daemon=True
+            ).start()
+
+    # Add to a counter in the pipeline stats
+    def count(self, stat, value=1):
+        with self.stats_lock:
+            self.stats[stat] += value
+
+    # Get the pipeline stats, including current queue depths
+    def queue_stats(self):
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats['event_depth'] = self.event_queue.qsize()
+        stats['sql_depth'] = self.sql_queue.qsize()
+        return stats
+
+    # Verify a webhook before its body is parsed
+    #   'body' is the raw request body (bytes), 'headers' are the headers
+    #   The cheapest checks are done first, so junk is rejected quickly
+    #   Returns True if the webhook is genuine, and has not been seen before
+    def verify_webhook(self, body, headers):
+        timestamp = headers.get('Junos-Timestamp')
+        nonce = headers.get('Junos-Nonce')
+        signature = headers.get('Junos-Signature')
+        if not timestamp or not nonce or not signature:
+            self.count('rejected')
+            return False
+
+        # Reject old (or future) webhooks
+        max_skew = self.config['config'].get('max_skew', 300)
+        try:
+            skew = abs(time.time() - int(timestamp))
+        except ValueError:
+            skew = None
+        if skew is None or skew > max_skew:
+            self.count('rejected')
+            return False
+
+        # Check the signature, in constant time
+        if isinstance(body, str):
+            body = body.encode()
+        expected = hmac.new(
+            self.config['config']['webhook_secret'].encode(),
+            f"{timestamp}.{nonce}.".encode() + body,
+            hashlib.sha256
+        ).hexdigest()
+        if not hmac.compare_digest(expected, signature):
+            self.count('rejected')
+            return False
+
+        # Reject nonces we've already seen, and remember this one
+        #   This is one locked step, so two copies of a webhook arriving
+        #   together can't both pass
+        #   Nonces are kept until the timestamp would be stale anyway,
+        #   and the oldest are removed when the cache is full
+        now = time.monotonic()
+        cache_size = self.config['config'].get('nonce_cache_size', 10000)
+        with self.nonce_lock:
+            expires = self.nonces.get(nonce)
+            if expires is not None and expires > now:
+                self.count('replayed')
                 return False
 
+            self.nonces[nonce] = now + max_skew * 2
+            self.nonces.move_to_end(nonce)
+            while self.nonces:
+                oldest = next(iter(self.nonces))
+                if len(self.nonces) > cache_size or \
+                        self.nonces[oldest] <= now:
+                    del self.nonces[oldest]
+                else:
+                    break
+
+        return True
+
+    # Handle a raw webhook, before the core has parsed it
+    #   The core must call this (rather than handle_event()) for the
+    #   timestamp, nonce and signature to be checked
+    #   The body is decoded with wire.decode(), so it may be gzip compressed
+    #   Returns True if the webhook was accepted
+    def handle_webhook(self, body, headers, src):
+        if not self.verify_webhook(body, headers):
+            print(termcolor.colored(
+                f"Rejected a Junos webhook from {src}",
+                "red"
+            ))
+            return False
+
+        try:
+            events = wire.decode(body, headers)
+        except (OSError, EOFError, ValueError):
+            self.count('rejected')
+            return False
+
+        self.handle_event(events, src)
+        return True
+
     # Handle the event as it comes in
+    #   This can be a single event, or a batch (list) of events
+    #   Queue it for the workers, so the webhook can return immediately
+    #   Repeats of a recent event are counted, rather than queued
     def handle_event(self, raw_response, src):
-        # Add the sending IP to the event
+        # The agent may send a batch of events, as a list
+        if isinstance(raw_response, list):
+            for event in raw_response:
+                if isinstance(event, dict):
+                    self.handle_event(event, src)
+            return
+
+        # The agent may use the compact format (short keys)
+        raw_response = wire.expand(raw_response)
+
+        # Add the sending IP and time received to the event
         raw_response['source'] = src
+        raw_response['received'] = datetime.now()
+        self.count('received')
+
+        if self.suppressed(raw_response):
+            return
+
+        self.enqueue(raw_response)
+
+    # Put an event on the queue for the chat workers
+    def enqueue(self, raw_response):
+        try:
+            self.event_queue.put_nowait(raw_response)
+        except queue.Full:
+            self.count('dropped')
+            print(termcolor.colored(
+                f"Junos event queue full, dropping {raw_response['event']}",
+                "red"
+            ))
+            return
+
+        with self.stats_lock:
+            self.stats['max_depth'] = max(
+                self.stats['max_depth'],
+                self.event_queue.qsize()
+            )
+
+    # Get the suppression window (seconds) for an event
+    def suppress_window(self, event):
+        suppression = self.config.get('suppression') or {}
+        windows = suppression.get('events') or {}
+        window = windows.get(event)
+        if window is None:
+            window = suppression.get('default', 0)
+        return window or 0
+
+    # Check if an event is a repeat of one seen in its suppression window
+    #   The first event is let through, and repeats are counted
+    def suppressed(self, raw_response):
+        window = self.suppress_window(raw_response['event'])
+        if window <= 0:
+            return False
+
+        # Timestamps and counters are removed, so they don't matter
+        #   Interface names and addresses are kept, so a flap on another
+        #   port is not hidden
+        message = (raw_response.get('message') or '').lower()
+        message = TIMESTAMP_REGEX.sub('#', message)
+        message = COUNTER_REGEX.sub('#', message)
+        key = (
+            raw_response.get('hostname'),
+            raw_response['event'],
+            ' '.join(message.split())
+        )
+
+        now = time.monotonic()
+        with self.suppress_lock:
+            entry = self.suppress_list.get(key)
+            if entry is not None and now < entry['expires']:
+                entry['count'] += 1
+                self.count('suppressed')
+                return True
+
+            self.suppress_list[key] = {
+                'event': raw_response,
+                'count': 1,
+                'window': window,
+                'expires': now + window
+            }
+
+        return False
+
+    # Send a summary for each suppression window that has ended
+    #   Only windows that had repeats need a summary
+    #   The first event was already sent, so only the repeats are counted
+    def suppress_worker(self):
+        while True:
+            time.sleep(1)
+            now = time.monotonic()
+            summaries = []
 
+            with self.suppress_lock:
+                for key in list(self.suppress_list):
+                    entry = self.suppress_list[key]
+                    if now < entry['expires']:
+                        continue
+                    del self.suppress_list[key]
+                    if entry['count'] > 1:
+                        summaries.append(entry)
+
+            for entry in summaries:
+                summary = dict(entry['event'])
+                summary['repeats'] = entry['count'] - 1
+                summary['window'] = entry['window']
+                self.enqueue(summary)
+
+    # Take events from the queue, and process them
+    def chat_worker(self):
+        while True:
+            raw_response = self.event_queue.get()
+            try:
+                self.process_event(raw_response)
+            except Exception as err:
+                print(termcolor.colored(
+                    f"Error processing Junos event: {err}",
+                    "red"
+                ))
+            finally:
+                self.count('processed')
+                self.event_queue.task_done()
+
+    # Take SQL writes from the queue, and write them to the database
+    #   Rows are buffered, and written in batches
+    #   A batch is written when it's full, or when it's old enough
+    def sql_worker(self):
+        batch_size = self.config['config'].get('sql_batch_size', 100)
+        batch_ms = self.config['config'].get('sql_batch_ms', 500)
+        buffer = []
+        deadline = None
+
+        while True:
+            # Wait for the next row, but not past the batch deadline
+            if deadline is None:
+                timeout = None
+            else:
+                timeout = max(0, deadline - time.monotonic())
+
+            try:
+                row = self.sql_queue.get(timeout=timeout)
+            except queue.Empty:
+                row = None
+
+            stopping = row is SQL_STOP
+            if row is not None and not stopping:
+                buffer.append(row)
+                if deadline is None:
+                    deadline = time.monotonic() + batch_ms / 1000
+
+            # When stopping, also write rows that chat workers queued
+            #   after the stop was requested
+            while stopping:
+                try:
+                    row = self.sql_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if row is SQL_STOP:
+                    self.sql_queue.task_done()
+                else:
+                    buffer.append(row)
+
+            # Write the batch if it's full, old enough, or we're stopping
+            if buffer and (
+                stopping or
+                len(buffer) >= batch_size or
+                time.monotonic() >= deadline
+            ):
+                self.sql_flush(buffer)
+                for _ in buffer:
+                    self.sql_queue.task_done()
+                buffer = []
+                deadline = None
+
+            if stopping:
+                self.sql_queue.task_done()
+                self.sql_close()
+                return
+
+    # Write a batch of rows in a single parameterized insert
+    def sql_flush(self, rows):
+        try:
+            if self.sql_conn is None:
+                self.sql_conn = pyodbc.connect(
+                    'Driver={SQL Server};'
+                    f"Server={GLOBAL['db_server']};"
+                    f"Database={GLOBAL['db_name']};"
+                    'Trusted_Connection=yes;'
+                )
+
+            cursor = self.sql_conn.cursor()
+            cursor.fast_executemany = True
+            cursor.executemany(self.sql_string, rows)
+            self.sql_conn.commit()
+            cursor.close()
+            self.count('written', len(rows))
+
+        # Drop the connection, so the next batch reconnects
+        except Exception as err:
+            self.count('sql_failed', len(rows))
+            print(termcolor.colored(
+                f"Error writing {len(rows)} Junos events to SQL: {err}",
+                "red"
+            ))
+            self.sql_close()
+
+    # Close the SQL connection, if it's open
+    def sql_close(self):
+        if self.sql_conn is None:
+            return
+        try:
+            self.sql_conn.close()
+        except Exception:
+            pass
+        self.sql_conn = None
+
+    # Stop the pipeline, writing any buffered rows to SQL first
+    #   Chat workers may still queue rows, so don't wait for the queue to
+    #   be empty; wait (with a timeout) for the SQL worker to finish instead
+    def stop(self):
+        if self.stopped:
+            return
+        self.stopped = True
+        self.send_digest()
+        try:
+            self.sql_queue.put(SQL_STOP, timeout=STOP_TIMEOUT)
+        except queue.Full:
+            print(termcolor.colored(
+                "Junos SQL queue full, some events not written",
+                "red"
+            ))
+            return
+        self.sql_thread.join(timeout=STOP_TIMEOUT)
+
+    # Process an event from the queue
+    def process_event(self, raw_response):
         # Assign a priority to the event
         self.alert_priority(raw_response)
 
         # Cleanup the message string
         raw_response['message'] = \
             raw_response['message'].replace(raw_response['event'], "")
-        raw_response['message'] = raw_response['message'].replace("'", "")
+
+        # Summaries of suppressed events include the count
+        if 'repeats' in raw_response:
+            raw_response['message'] = (
+                f"{raw_response['event']} repeated "
+                f"{raw_response['repeats']} more times "
+                f"in last {raw_response['window']}s: "
+                f"{raw_response['message']}"
+            )
 
         # Depending on priority,
         # print event to terminal and prepare message for Teams
@@ -99,7 +630,13 @@ class JunosHandler(plugin.PluginTemplate):
                 self.log(message, raw_response)
 
             # Priority 2
+            #   In digest mode, these are sent together later
             case 2:
+                if self.digest_interval > 0:
+                    with self.digest_lock:
+                        self.digest.append(raw_response)
+                    return
+
                 message = f"{raw_response['message']} on \
                     <span style=\"color:Lime\"><b> \
                     {raw_response['hostname']}</b></span>"
@@ -113,18 +650,90 @@ class JunosHandler(plugin.PluginTemplate):
             case _:
                 pass
 
+    # Build the event classifier from the config
+    def load_classifier(self, config=None):
+        config = config or self.config
+        return EventClassifier(
+            events=config.get('events'),
+            rules=config.get('rules'),
+            default=config['config'].get('default_level', 1)
+        )
+
+    # Get the modification times of the config files
+    def config_mtimes(self):
+        mtimes = {}
+        for path in (LOCATION, ENTITIES):
+            try:
+                mtimes[path] = os.stat(path).st_mtime
+            except OSError:
+                mtimes[path] = None
+        return mtimes
+
+    # Watch the config files, and reload them when they change
+    def watch_worker(self):
+        while not self.stopped:
+            time.sleep(self.config['config'].get('reload_interval', 5))
+            mtimes = self.config_mtimes()
+            if mtimes != self.mtimes:
+                self.mtimes = mtimes
+                self.reload()
+
+    # Check that a config has everything the plugin needs
+    #   Returns an error message, or None if the config is valid
+    def validate_config(self, config):
+        if not isinstance(config, dict):
+            return 'the file is empty, or not a YAML mapping'
+        if not isinstance(config.get('config'), dict):
+            return "the 'config' section is missing"
+        for key in ('sql_table', 'chat_id', 'ftp_server', 'ftp_dir'):
+            if key not in config['config']:
+                return f"'{key}' is missing from the 'config' section"
+        for event, level in (config.get('events') or {}).items():
+            if level is not None and level not in (1, 2, 3, 4):
+                return f"{event} has an invalid level ({level})"
+        return None
+
+    # Reload the config and entities files
+    #   Everything is parsed and built first, then swapped in
+    #   If there are any errors, the current config is kept
+    def reload(self):
+        try:
+            config = load_yaml(LOCATION)
+            entities = load_yaml(ENTITIES)
+
+            error = self.validate_config(config)
+            if error:
+                raise ValueError(error)
+
+            classifier = self.load_classifier(config)
+            profiles = self.load_profiles(config)
+
+        except Exception as err:
+            print(termcolor.colored(
+                f"Junos config not reloaded, keeping the old one: {err}",
+                "red"
+            ))
+            return False
+
+        self.config = config
+        self.classifier = classifier
+        self.profiles = profiles
+        self.entities = entities
+        self.ftp_server = config['config']['ftp_server']
+        self.ftp_dir = config['config']['ftp_dir']
+        print(termcolor.colored("Junos config reloaded", "green"))
+        return True
+
     # Assign a priority to an event
     def alert_priority(self, webhook):
-        if webhook['event'] in self.config['events']:
-            webhook['level'] = self.config['events'][webhook['event']]
-        else:
-            webhook['level'] = 1
+        webhook['level'] = self.classifier.classify(
+            webhook['event'],
+            webhook.get('hostname', ''),
+            webhook.get('message', '')
+        )
 
     # Log to SQL and terminal, send to teams
     def log(self, message, event):
-        date = datetime.now().date()
-        time = datetime.now().time().strftime("%H:%M:%S")
-
         try:
             chat_id = teamschat.send_chat(
                 message,
@@ -136,17 +745,86 @@ class JunosHandler(plugin.PluginTemplate):
             print(termcolor.colored(err, "red"))
             return
 
-        fields = {
-            'device': f"'{event['hostname']}'",
-            'event': f"'{event['event']}'",
-            'description': f"'{event['message']}'",
-            'logdate': f"'{date}'",
-            'logtime': f"'{time}'",
-            'source': f"{self.ip2integer(event['source'])}",
-            'message': f"'{chat_id}'"
-        }
+        self.queue_sql(event, chat_id)
+
+    # Queue an event for the SQL worker to write
+    #   'chat_id' is the ID of the Teams message for this event
+    def queue_sql(self, event, chat_id):
+        received = event.get('received', datetime.now())
+
+        # Values, in the same order as SQL_COLUMNS
+        #   These are typed (date, time, int), not strings, and are passed
+        #   as parameters, so quotes in the message don't need removing
+        row = (
+            event['hostname'],
+            event['event'],
+            event['message'],
+            received.date(),
+            received.time().replace(microsecond=0),
+            self.ip2integer(event['source']),
+            chat_id
+        )
+
+        # Queue the SQL write for the SQL worker
+        #   If the database is slow, wait for a while (backpressure)
+        try:
+            self.sql_queue.put(row, timeout=SQL_QUEUE_WAIT)
+        except queue.Full:
+            self.count('sql_dropped')
+            print(termcolor.colored(
+                "Junos SQL queue full, event not written",
+                "red"
+            ))
 
-        self.sql_write(
-            database=self.config['config']['sql_table'],
-            fields=fields
+    # Send buffered priority 2 events on a schedule
+    def digest_worker(self):
+        while not self.stopped:
+            time.sleep(self.digest_interval)
+            self.send_digest()
+
+    # Send buffered priority 2 events as a single table
+    #   Events are grouped by device and event
+    def send_digest(self):
+        with self.digest_lock:
+            events = self.digest
+            self.digest = []
+
+        if not events:
+            return
+
+        groups = {}
+        for event in events:
+            key = (event['hostname'], event['event'])
+            if key not in groups:
+                groups[key] = {'count': 0, 'message': ''}
+            groups[key]['count'] += event.get('repeats', 1)
+            groups[key]['message'] = event['message']
+
+        rows = ''.join(
+            f"<tr><td>{device}</td><td>{name}</td>"
+            f"<td>{group['count']}</td><td>{group['message']}</td></tr>"
+            for (device, name), group in sorted(groups.items())
+        )
+        message = (
+            f"<b>Junos events (last {self.digest_interval}s)</b><br>"
+            "<table><tr><th>Device</th><th>Event</th><th>Count</th>"
+            f"<th>Last message</th></tr>{rows}</table>"
         )
+
+        try:
+            chat_id = teamschat.send_chat(
+                message,
+                self.config['config']['chat_id']
+            )['id']
+            print(termcolor.colored(
+                f"Junos digest: {len(events)} events",
+                "yellow"
+            ))
+        except Exception as err:
+            print(termcolor.colored("Error sending Junos digest", "red"))
+            print(termcolor.colored(err, "red"))
+            return
+
+        # Each event is still written to SQL, with the digest's message ID
+        for event in events:
+            self.queue_sql(event, chat_id)
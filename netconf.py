@@ -3,14 +3,27 @@ Supporting functions to connect to a junos device
 
 Usage:
     Call junos_connect() to connnect to a device
+        Pass 'facts=False' to skip gathering facts when connecting
     Call send_shell() to send a shell command to a device
+    Use a ShellSession to send many shell commands over one channel
+    Call put_file() to copy a file (such as a script) to a device
+    Call junos_release() to return a device to the session pool
+    Call is_device() to check if junos_connect() returned a device
+
+Session Pool:
+    Connections are kept in a pool, keyed on host and credentials
+    junos_connect() reuses an idle, healthy session if there is one
+    Idle sessions are closed after POOL_IDLE_TIMEOUT seconds
+        A background reaper checks for these every POOL_REAP_INTERVAL seconds
+    No more than POOL_MAX_PER_DEVICE sessions are open to one device
+    The least recently used idle session is closed when the pool is full
 
 Authentication:
     Supports username and password for login to NETCONF over SSH
     Junos supports RSA keys, but this script currently does not
 
 Restrictions:
-    Requires JunosPyEZ to be installed
+    Requires JunosPyEZ to be installed (imported on first use)
     Requres a username/password to connect
     Requires NetConf to be enabled on the target device
 
@@ -22,61 +35,346 @@ Author:
 """
 
 import termcolor
-from jnpr.junos import Device
-from jnpr.junos.utils.start_shell import StartShell
-import jnpr.junos.exception
+import threading
+import hashlib
+import time
+from collections import OrderedDict
 from core import teamschat
 
+# PyEZ is imported when it's first needed, rather than here
+#   This keeps plugin startup fast when only webhooks are used
+
+
+# Session pool settings
+#   Idle timeout and health check interval are in seconds
+POOL_IDLE_TIMEOUT = 300
+POOL_HEALTH_INTERVAL = 30
+POOL_MAX_PER_DEVICE = 2
+POOL_MAX_IDLE = 50
+POOL_WAIT_TIMEOUT = 120
+POOL_REAP_INTERVAL = 60
+
+# Idle sessions, oldest first (for LRU eviction)
+#   id(dev) : {'key': tuple, 'dev': Device, 'last_used': float}
+_idle = OrderedDict()
+
+# Number of open sessions (idle or in use) for each pool key
+_open_count = {}
+
+# The pool key for each open session
+_session_keys = {}
+
+_pool_lock = threading.Condition()
+
+# The thread that closes idle sessions, started when the pool is first used
+_reaper = None
+
+
+# Build a pool key from the host and credentials
+#   The password is hashed, so it is not held in the key
+def _pool_key(host, user, password):
+    digest = hashlib.sha256(password.encode()).hexdigest()
+    return (host.lower(), user, digest)
+
+
+# Close a session, ignoring any errors from a dead connection
+def _close_quietly(dev):
+    try:
+        dev.close()
+    except Exception:
+        pass
+
+
+# Forget about a session that is being closed
+#   Must be called while holding _pool_lock
+def _forget(dev):
+    key = _session_keys.pop(id(dev), None)
+    if key is not None:
+        _open_count[key] -= 1
+        if _open_count[key] <= 0:
+            del _open_count[key]
+    _pool_lock.notify_all()
+
+
+# Remove idle sessions that have timed out, and return them for closing
+#   Must be called while holding _pool_lock
+def _expire_idle():
+    expired = []
+    now = time.monotonic()
+    for session_id in list(_idle):
+        if now - _idle[session_id]['last_used'] > POOL_IDLE_TIMEOUT:
+            expired.append(_idle.pop(session_id)['dev'])
+    for dev in expired:
+        _forget(dev)
+    return expired
+
+
+# Close idle sessions that have timed out, in the background
+#   Without this, sessions would stay open until the next junos_connect()
+def _reap():
+    while True:
+        time.sleep(POOL_REAP_INTERVAL)
+        with _pool_lock:
+            expired = _expire_idle()
+        for dev in expired:
+            _close_quietly(dev)
+
+
+# Start the reaper thread, if it's not running yet
+def _start_reaper():
+    global _reaper
+    with _pool_lock:
+        if _reaper is not None:
+            return
+        _reaper = threading.Thread(
+            target=_reap,
+            name='junos-pool-reaper',
+            daemon=True
+        )
+        _reaper.start()
+
+
+# Check that an idle session is still usable
+#   A cheap RPC is only sent if the session has been idle for a while
+def _healthy(dev, last_used):
+    if not dev.connected:
+        return False
+    if time.monotonic() - last_used < POOL_HEALTH_INTERVAL:
+        return True
+    try:
+        dev.rpc.get_system_uptime_information()
+    except Exception:
+        return False
+    return True
+
 
 # Connect to a Junos device
-def junos_connect(host, user, password):
+#   Reuses an idle session from the pool if possible
+#   With 'facts=False', facts are not gathered when the session opens
+#       PyEZ will still fetch a fact if it's read later
+def junos_connect(host, user, password, facts=True):
+    from jnpr.junos import Device
+    import jnpr.junos.exception
+
+    _start_reaper()
+
+    key = _pool_key(host, user, password)
+    deadline = time.monotonic() + POOL_WAIT_TIMEOUT
+
+    while True:
+        with _pool_lock:
+            stale = _expire_idle()
+
+            # Find an idle session for this device (most recent first)
+            entry = None
+            for session_id in reversed(_idle):
+                if _idle[session_id]['key'] == key:
+                    entry = _idle.pop(session_id)
+                    break
+
+            # No idle sessions, so we may need to open a new one
+            if entry is None:
+                if _open_count.get(key, 0) < POOL_MAX_PER_DEVICE:
+                    _open_count[key] = _open_count.get(key, 0) + 1
+                    reserved = True
+                else:
+                    reserved = False
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return jnpr.junos.exception.ConnectError(
+                            Device(host, user=user, password=password),
+                            msg='Too many sessions open to this device'
+                        )
+                    _pool_lock.wait(remaining)
+
+        for dev in stale:
+            _close_quietly(dev)
+
+        # Reuse an idle session, if it's still healthy
+        if entry is not None:
+            if _healthy(entry['dev'], entry['last_used']):
+                return entry['dev']
+
+            with _pool_lock:
+                _forget(entry['dev'])
+            _close_quietly(entry['dev'])
+            continue
+
+        if reserved:
+            break
+
+    # Open a new session
     try:
-        dev = Device(host, user=user, password=password).open()
+        dev = Device(
+            host,
+            user=user,
+            password=password,
+            gather_facts=facts
+        ).open()
     except Exception as err:
+        with _pool_lock:
+            _open_count[key] -= 1
+            if _open_count[key] <= 0:
+                del _open_count[key]
+            _pool_lock.notify_all()
         return err
+
+    with _pool_lock:
+        _session_keys[id(dev)] = key
+
     return (dev)
 
 
-# Send shell commands to the device
-# Take the command to run, as well as the shell object
-def send_shell(cmd, dev):
-    # Print the command we're going to run
-    print(termcolor.colored(cmd, "yellow"))
+# Check if an object is a device connection (rather than an error)
+def is_device(dev):
+    from jnpr.junos import Device
+    return isinstance(dev, Device)
+
+
+# Return a session to the pool when finished with it
+#   Set 'discard' if the session should not be reused (eg, after a reboot)
+def junos_release(dev, discard=False):
+    if not is_device(dev):
+        return
+
+    evicted = []
+    with _pool_lock:
+        # Sessions not opened by the pool are just closed
+        if id(dev) not in _session_keys:
+            discard = True
+
+        elif discard or not dev.connected:
+            discard = True
+            _forget(dev)
+
+        else:
+            _idle[id(dev)] = {
+                'key': _session_keys[id(dev)],
+                'dev': dev,
+                'last_used': time.monotonic()
+            }
+
+            # Evict the least recently used idle sessions
+            while len(_idle) > POOL_MAX_IDLE:
+                old = _idle.popitem(last=False)[1]['dev']
+                _forget(old)
+                evicted.append(old)
+
+    if discard:
+        _close_quietly(dev)
+    for old in evicted:
+        _close_quietly(old)
+
 
-    # Convert the raw junos command to something the API can work with
-    command = f'cli -c \'{cmd}\''
+# A shell channel on a device, that is reused for many commands
+#   Use as a context manager, so the channel is always closed
+#   The channel is opened when the first command is run
+class ShellSession:
+    def __init__(self, dev, timeout=60):
+        self.dev = dev
+        self.timeout = timeout
+        self.shell = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
 
     # Connect to the device shell (for sending CLI commands)
+    def open(self):
+        from jnpr.junos.utils.start_shell import StartShell
+        import jnpr.junos.exception
+
+        try:
+            self.shell = StartShell(self.dev, timeout=self.timeout)
+            self.shell.open()
+        except jnpr.junos.exception.ConnectError as err:
+            print(termcolor.colored(
+                'There was an error connecting to the Junos shell: ' +
+                repr(err),
+                "red"
+            ))
+            self.shell = None
+            return err
+        return True
+
+    # Close the shell channel, if it's open
+    def close(self):
+        if self.shell is None:
+            return
+        try:
+            self.shell.close()
+        except Exception:
+            pass
+        self.shell = None
+
+    # Run a junos command in the shell
+    def run(self, cmd, timeout=0):
+        # Print the command we're going to run
+        print(termcolor.colored(cmd, "yellow"))
+
+        # Convert the raw junos command to something the API can work with
+        command = f'cli -c \'{cmd}\''
+        return self.run_shell(command, timeout)
+
+    # Run a raw command in the device's unix shell
+    #   'timeout' overrides the session timeout (in seconds)
+    def run_shell(self, command, timeout=0):
+        if self.shell is None:
+            result = self.open()
+            if result is not True:
+                return result
+
+        # Attempt the command
+        #   If this fails, the channel may be broken, so close it
+        #   The next command will open a new channel
+        try:
+            output = self.shell.run(command, timeout=timeout)
+        except Exception as err:
+            print('An error has occurred')
+            print('Sometimes a device will get busy and reject the attempt')
+            self.close()
+            return err
+
+        # Cleanup the output before returning
+        # Extract the actual message, and remove excessive blank lines
+        out_text = output[1].replace(command, "")
+        out_text = out_text.replace("\r\r\n", "")
+
+        # Return the response from the device
+        return (out_text)
+
+
+# Send a single shell command to the device
+#   Use ShellSession directly when sending several commands
+def send_shell(cmd, dev):
+    with ShellSession(dev) as shell:
+        return shell.run(cmd)
+
+
+# Copy a local file to the device
+#   Returns True if successful, or the error if not
+def put_file(dev, local_path, remote_path):
+    from jnpr.junos.utils.scp import SCP
+
     try:
-        shell = StartShell(dev, timeout=60)
-        shell.open()
-    except jnpr.junos.exception.ConnectError as err:
+        with SCP(dev) as scp:
+            scp.put(local_path, remote_path=remote_path)
+    except Exception as err:
         print(termcolor.colored(
-            'There was an error connecting to the Junos shell: ' + repr(err),
+            f'Could not copy {local_path} to the device: {repr(err)}',
             "red"
         ))
         return err
-
-    # Attempt the command
-    try:
-        output = shell.run(command)
-    except Exception as err:
-        print('An error has occurred')
-        print('Sometimes a device will get busy and reject the attempt')
-        return err
-
-    # Cleanup the output before returning
-    # Extract the actual message, and remove excessive blank lines
-    out_text = output[1].replace(command, "")
-    out_text = out_text.replace("\r\r\n", "")
-
-    # Return the response from the device
-    shell.close()
-    return (out_text)
+    return True
 
 
 # Handle errors when they occur
 def error_handler(err, dev, chat_id):
+    import jnpr.junos.exception
+
     if isinstance(err, str):
         if 'could not fetch local copy of file' in err:
             teamschat.send_chat(
@@ -122,8 +420,6 @@ def error_handler(err, dev, chat_id):
                 'red'
             ))
 
-        dev.close()
-
     elif isinstance(err, jnpr.junos.exception.ConnectRefusedError):
         teamschat.send_chat(
             "Sorry. It refused my connection. <br> \
@@ -169,3 +465,6 @@ def error_handler(err, dev, chat_id):
                 <span style=\"color:Red\">{repr(err)}</span>",
             chat_id
         )
+
+    # Close the session, as it may be in an unknown state
+    junos_release(dev, discard=True)
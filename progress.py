@@ -0,0 +1,115 @@
+"""
+Reports the progress of long running device jobs to Teams
+Updates are coalesced, so each job sends a few messages, not one per step
+
+Usage:
+    Create a Progress object for a job (or a multi-device run)
+    Call update() for each step; call finish() with an optional summary
+    The same Progress object can be shared between threads
+
+Coalescing:
+    The first update is sent straight away
+    Updates within 'progress_interval' seconds of the last message are held,
+        and sent together (one line each) when the interval is up
+    flush() sends anything that is held, straight away
+    Messages are posted outside the lock, so a slow post doesn't hold up
+        other threads; a failed post is printed, and the job carries on
+
+Restrictions:
+    The Teams API (core/teamschat) can only post new messages,
+        so updates are combined, rather than edited in place
+
+To Do:
+    None
+"""
+
+from core import teamschat
+from plugins.junos.settings import plugin_setting
+import termcolor
+import threading
+import time
+
+
+# The default time (seconds) to hold updates for
+PROGRESS_INTERVAL = 10
+
+
+# Coalesces progress updates into as few messages as possible
+class Progress:
+    def __init__(self, chat_id, interval=None):
+        self.chat_id = chat_id
+        if interval is None:
+            interval = plugin_setting('progress_interval', PROGRESS_INTERVAL)
+        self.interval = interval
+        self.pending = []
+        self.last_sent = None
+        self.timer = None
+        self.lock = threading.Lock()
+
+    # Add an update for a job
+    #   'device' is added to the start, if given
+    def update(self, message, device=None):
+        if device:
+            message = f"<b>{device}</b>: {message}"
+
+        outgoing = None
+        with self.lock:
+            self.pending.append(message)
+
+            # Send now if there was no recent message
+            wait = 0
+            if self.last_sent is not None:
+                wait = self.interval - (time.monotonic() - self.last_sent)
+            if wait <= 0:
+                outgoing = self.take()
+
+            # Otherwise, send when the interval is up
+            elif self.timer is None:
+                self.timer = threading.Timer(wait, self.flush)
+                self.timer.start()
+
+        self.send(outgoing)
+
+    # Send any held updates now
+    def flush(self):
+        with self.lock:
+            message = self.take()
+        self.send(message)
+
+    # Send held updates, with a final summary
+    def finish(self, summary=None):
+        with self.lock:
+            if summary:
+                self.pending.append(summary)
+            message = self.take()
+        self.send(message)
+
+    # Take the held updates, as one message (or None if there are none)
+    #   Must be called with the lock held
+    def take(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        if not self.pending:
+            return None
+
+        message = '<br>'.join(self.pending)
+        self.pending = []
+        self.last_sent = time.monotonic()
+        return message
+
+    # Post a message to Teams
+    #   Called without the lock, so other threads can keep adding updates
+    #   Errors are printed, so they don't stop the job (or the timer)
+    def send(self, message):
+        if message is None:
+            return
+
+        try:
+            teamschat.send_chat(message, self.chat_id)
+        except Exception as err:
+            print(termcolor.colored(
+                f"Could not send a progress update: {err}",
+                "red"
+            ))
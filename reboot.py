@@ -5,6 +5,19 @@ Immediately, in a given time, or at a given time
 Usage:
     TBA
 
+Rolling Reboots:
+    Add 'rolling' to an immediate reboot request to reboot in waves
+    Each wave has up to 'reboot_wave_size' devices,
+        with up to 'reboot_workers' rebooting at once
+    If 'reboot_wait' is set, the next wave starts when every device in this
+        wave is back online (or 'reboot_wait_timeout' seconds have passed)
+    The rest of the waves are cancelled if more than
+        'reboot_max_failures' devices fail
+
+Watching:
+    Devices that are rebooted immediately are watched until they're back
+        (see watcher.py), and their downtime is reported and recorded
+
 Authentication:
     Supports username and password for login to NETCONF over SSH
     Junos supports RSA keys, but this script currently does not
@@ -14,6 +27,7 @@ Restrictions:
     Requres a username/password to connect
     Requires NETCONF to be enabled on the target device
     Requires dateutil (pip install python-dateutil)
+    PyEZ and dateutil are imported on first use
 
 To Do:
     TBA
@@ -22,101 +36,123 @@ Author:
     Luke Robertson - March 2023
 """
 
-# 'SW' is the 'Software Utility' class
-# This is used for upgrades, file copies, reboots, etc
-from jnpr.junos import Device
-from jnpr.junos.utils.sw import SW
-from jnpr.junos.exception import ConnectError
-from jnpr.junos.exception import RpcError
-
+# PyEZ and dateutil are imported in the functions that use them
+#   This keeps plugin startup fast
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from dateutil.parser import parse
-from core import crypto
-from core import teamschat
+from plugins.junos import credentials
+from plugins.junos import facts
+from plugins.junos import netconf
+from plugins.junos import watcher
+from plugins.junos.progress import Progress
+from plugins.junos.settings import plugin_setting
 import threading
 
 
+# Default settings for fleet reboots, used if they're not in the config
+#   Times are in seconds
+REBOOT_WORKERS = 5
+REBOOT_WAVE_SIZE = 5
+REBOOT_MAX_FAILURES = 1
+
+
 # Reboot a device under various conditions
 #   Now, in a particular time, at a particular time
 # This is a function built into the junosPyEz library
 #   We don't need to keep connection objects and send CLI commands
-def reboot(device, user, password, chat_id, **kwargs):
+def reboot(device, user, password, chat_id, progress=None, **kwargs):
     '''
     Reboots a Junos device
     'time' parameter (datetime object) - Reboot at a time
     'duration' parameter (positive integer) - Reboot in a given time (minutes)
     No parameter - Reboot immediately
+    'progress' - A shared Progress object, to coalesce updates
+    Returns True if the reboot was accepted, or False
     '''
 
+    if progress is None:
+        progress = Progress(chat_id)
+
+    # 'SW' is the 'Software Utility' class
+    # This is used for upgrades, file copies, reboots, etc
+    from jnpr.junos.utils.sw import SW
+    from jnpr.junos.exception import ConnectAuthError
+    from jnpr.junos.exception import ConnectError
+    from jnpr.junos.exception import RpcError
+
     print(f"Connecting to {device}...")
 
     # Connect to the device
+    #   Facts are read when needed, and the facts cache is kept up to date
+    dev = None
     try:
-        with Device(host=device, user=user, passwd=password) as dev:
-            # Instantiate the 'Software Utility' class
-            try:
-                sw = SW(dev)
-            except Exception as err:
-                print("Could not create the software class")
-                print(err)
-                return
+        dev = netconf.junos_connect(device, user, password, facts=False)
+        if not netconf.is_device(dev):
+            raise dev
+        facts.get_facts(device, dev)
 
-            # If there are no parameters, reboot now
-            if kwargs == {}:
-                print("Rebooting now")
-                result = sw.reboot()
-
-            # If the 'time' parameter is present, reboot then
-            elif 'time' in kwargs:
-                if kwargs['time'] < datetime.now():
-                    print("This time is in the past")
-                    return
-
-                print(f"Rebooting at {kwargs['time']}")
-                # Convert the time to a format junos uses
-                junos_format = kwargs['time'].strftime("%y%m%d%H%M")
-                result = sw.reboot(at=junos_format)
-
-            # If the 'duration' parameter is present,
-            # reboot in that many minutes
-            elif 'duration' in kwargs:
-                if kwargs['duration'] < 1 or type(kwargs['duration']) != int:
-                    print("This needs to be a positive whole integer")
-                    return
-
-                print(f"Rebooting in: {kwargs['duration']} minutes")
-                result = sw.reboot(in_min=kwargs['duration'])
-
-            # If there are parameters, but not 'time' or 'duration',
-            # there is an error
-            else:
-                print("You have used invalid parameters")
-                print("  Pass no parameters to reboot now")
-                print("  Pass 'time' parameter to reboot at a particular time")
-                print("  Pass 'duration' to reboot in a number of minutes")
-
-            print(result)
-            teamschat.send_chat(
-                f"{device}: {result}",
-                chat_id
-            )
+        # Instantiate the 'Software Utility' class
+        try:
+            sw = SW(dev)
+        except Exception as err:
+            print("Could not create the software class")
+            print(err)
+            return False
+
+        # If there are no parameters, reboot now
+        if kwargs == {}:
+            print("Rebooting now")
+            result = sw.reboot()
+
+        # If the 'time' parameter is present, reboot then
+        elif 'time' in kwargs:
+            if kwargs['time'] < datetime.now():
+                print("This time is in the past")
+                return False
+
+            print(f"Rebooting at {kwargs['time']}")
+            # Convert the time to a format junos uses
+            junos_format = kwargs['time'].strftime("%y%m%d%H%M")
+            result = sw.reboot(at=junos_format)
+
+        # If the 'duration' parameter is present,
+        # reboot in that many minutes
+        elif 'duration' in kwargs:
+            if kwargs['duration'] < 1 or type(kwargs['duration']) != int:
+                print("This needs to be a positive whole integer")
+                return False
+
+            print(f"Rebooting in: {kwargs['duration']} minutes")
+            result = sw.reboot(in_min=kwargs['duration'])
+
+        # If there are parameters, but not 'time' or 'duration',
+        # there is an error
+        else:
+            print("You have used invalid parameters")
+            print("  Pass no parameters to reboot now")
+            print("  Pass 'time' parameter to reboot at a particular time")
+            print("  Pass 'duration' to reboot in a number of minutes")
+            return False
+
+        print(result)
+        progress.update(result, device)
+        return True
 
     # Handle Connection error
     except ConnectError as err:
         print(f"There has been a connection error: {err}")
-        teamschat.send_chat(
-            f"There was a problem connecting to {device}",
-            chat_id
-        )
+        if isinstance(err, ConnectAuthError):
+            credentials.invalidate('junos', device)
+        progress.update(f"There was a problem connecting to {device}")
 
     # Handle an RPC error
     except RpcError as err:
         if 'another shutdown is running' in str(err):
             print("Unable to reboot")
             print("Another reboot/shutdown has been scheduled")
-            teamschat.send_chat(
+            progress.update(
                 "Unable to reboot, as another reboot is scheduled",
-                chat_id
+                device
             )
 
         else:
@@ -126,6 +162,124 @@ def reboot(device, user, password, chat_id, **kwargs):
     except Exception as err:
         print(f"Error was: {err}")
 
+    # An immediate reboot drops the session, so don't return it to the pool
+    finally:
+        netconf.junos_release(dev, discard=(kwargs == {}))
+
+    return False
+
+
+# Reboot a list of devices, and send one summary when they're all done
+#   Each job is a dictionary of arguments for reboot()
+#   No more than 'reboot_workers' devices are rebooted at once
+#   Devices rebooted immediately are watched until they're back online
+def reboot_all(jobs, progress):
+    workers = min(len(jobs), plugin_setting('reboot_workers', REBOOT_WORKERS))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(
+            lambda job: reboot(progress=progress, **job),
+            jobs
+        ))
+
+    failed = [
+        job['device'] for job, result in zip(jobs, results) if not result
+    ]
+
+    # Scheduled reboots happen later, so only immediate reboots are watched
+    rebooted = [
+        job['device'] for job, result in zip(jobs, results)
+        if result and 'time' not in job and 'duration' not in job
+    ]
+    if rebooted:
+        progress.flush()
+        online = watcher.watch(rebooted, progress)
+        failed.extend(device for device in rebooted if not online[device])
+
+    # A single device reports its own result
+    if len(jobs) == 1:
+        progress.finish()
+        return
+
+    summary = f"Reboot: {len(jobs) - len(failed)} of {len(jobs)} devices OK"
+    if failed:
+        summary += (
+            f"<br><span style=\"color:Red\">Failed: "
+            f"{', '.join(failed)}</span>"
+        )
+    progress.finish(summary)
+
+
+# Reboot devices in waves, waiting for each wave to come back
+#   Each job is a dictionary of arguments for reboot()
+#   Stops if more than 'reboot_max_failures' devices fail
+def rolling_reboot(jobs, progress):
+    wave_size = max(1, plugin_setting('reboot_wave_size', REBOOT_WAVE_SIZE))
+    workers = max(1, plugin_setting('reboot_workers', REBOOT_WORKERS))
+    max_failures = plugin_setting('reboot_max_failures', REBOOT_MAX_FAILURES)
+
+    waves = [
+        jobs[index:index + wave_size]
+        for index in range(0, len(jobs), wave_size)
+    ]
+
+    back = []
+    failed = []
+    skipped = []
+    for number, wave in enumerate(waves, start=1):
+        progress.update(
+            f"Wave {number} of {len(waves)}: rebooting "
+            f"{', '.join(job['device'] for job in wave)}"
+        )
+
+        with ThreadPoolExecutor(
+            max_workers=min(workers, len(wave))
+        ) as executor:
+            results = list(executor.map(
+                lambda job: reboot(progress=progress, **job),
+                wave
+            ))
+            rebooted = [job for job, result in zip(wave, results) if result]
+            failed.extend(
+                job['device'] for job, result in zip(wave, results)
+                if not result
+            )
+
+        # Wait for the wave to come back before starting the next one
+        #   The watcher reports each device's downtime
+        devices = [job['device'] for job in rebooted]
+        online = dict.fromkeys(devices, True)
+        if devices and plugin_setting('reboot_wait', True):
+            progress.flush()
+            online = watcher.watch(devices, progress)
+
+        for device in devices:
+            if online[device]:
+                back.append(device)
+            else:
+                failed.append(device)
+
+        # Too many failures, so don't reboot any more devices
+        if len(failed) > max_failures:
+            skipped = [
+                job['device'] for later in waves[number:] for job in later
+            ]
+            if skipped:
+                progress.update(
+                    f"<span style=\"color:Red\">Stopping the rolling "
+                    f"reboot, as {len(failed)} devices failed</span>"
+                )
+            break
+
+    summary = f"Rolling reboot: {len(back)} of {len(jobs)} devices OK"
+    if failed:
+        summary += (
+            f"<br><span style=\"color:Red\">Failed: "
+            f"{', '.join(failed)}</span>"
+        )
+    if skipped:
+        summary += f"<br>Not rebooted: {', '.join(skipped)}"
+    progress.finish(summary)
+
 
 # Use NLP to parse the message, and handle the reboot
 def nlp_reboot(chat_id, **kwargs):
@@ -155,30 +309,39 @@ def nlp_reboot(chat_id, **kwargs):
             date = ent['ent'].lower()
             break
 
+    # Updates from all devices are coalesced into as few messages as possible
+    progress = Progress(chat_id)
+    jobs = []
+
     # If not, reboot now
     if time == '' and date == '':
         for device in device_list:
             print(f"Reboot requested for {device}")
-            secret = crypto.pw_decrypt(dev_type='junos', device=device)
+            secret = credentials.get_secret('junos', device)
             if not secret:
-                print("Could not get credentials")
-                return False
-            thread = threading.Thread(
-                target=reboot,
-                kwargs={
-                    'device': device,
-                    'user': secret['user'],
-                    'password': secret['password'],
-                    'chat_id': chat_id
-                }
-            )
-            thread.start()
-
-            teamschat.send_chat(
-                f"Reboot requested for {device}",
-                chat_id
+                print(f"Could not get credentials for {device}")
+                progress.update(
+                    "I couldn't get a password to connect, so I'm skipping it",
+                    device
+                )
+                continue
+            jobs.append({
+                'device': device,
+                'user': secret['user'],
+                'password': secret['password'],
+                'chat_id': chat_id
+            })
+
+            progress.update(
+                f"Reboot requested{facts.describe(device)}",
+                device
             )
 
+        # A rolling reboot goes through the devices in waves
+        if 'rolling' in kwargs.get('message', '').lower():
+            start_reboots(jobs, progress, rolling=True)
+        else:
+            start_reboots(jobs, progress)
         return
 
     # If the reboot should happen in a relative time from now
@@ -203,31 +366,32 @@ def nlp_reboot(chat_id, **kwargs):
                 return
 
         for device in device_list:
-            secret = crypto.pw_decrypt(dev_type='junos', device=device)
+            secret = credentials.get_secret('junos', device)
             if not secret:
-                print("Could not get credentials")
-                return False
-            thread = threading.Thread(
-                target=reboot,
-                kwargs={
-                    'device': device,
-                    'user': secret['user'],
-                    'password': secret['password'],
-                    'chat_id': chat_id,
-                    'duration': time_value
-                }
-            )
-            thread.start()
-
-            teamschat.send_chat(
-                f"Rebooting {device} in {time_value} minutes",
-                chat_id
+                print(f"Could not get credentials for {device}")
+                progress.update(
+                    "I couldn't get a password to connect, so I'm skipping it",
+                    device
+                )
+                continue
+            jobs.append({
+                'device': device,
+                'user': secret['user'],
+                'password': secret['password'],
+                'chat_id': chat_id,
+                'duration': time_value
+            })
+
+            progress.update(
+                f"Rebooting in {time_value} minutes{facts.describe(device)}",
+                device
             )
             print(f"Rebooting {device} in {time_value} minutes")
 
     # If the reboot should happen at an absolute time
     else:
         # Attempt to parse the time into something recognisable
+        from dateutil.parser import parse
         try:
             dt = parse(time)
         except Exception as err:
@@ -242,25 +406,40 @@ def nlp_reboot(chat_id, **kwargs):
         # Execute the reboot
         for device in device_list:
             print(f"Rebooting {device} at {dt}")
-            secret = crypto.pw_decrypt(dev_type='junos', device=device)
+            secret = credentials.get_secret('junos', device)
             if not secret:
-                print("Could not get credentials")
-                return False
-            thread = threading.Thread(
-                target=reboot,
-                kwargs={
-                    'device': device,
-                    'user': secret['user'],
-                    'password': secret['password'],
-                    'chat_id': chat_id,
-                    'time': dt
-                }
-            )
-            thread.start()
-
-            teamschat.send_chat(
-                f"Rebooting {device} at {dt}",
-                chat_id
+                print(f"Could not get credentials for {device}")
+                progress.update(
+                    "I couldn't get a password to connect, so I'm skipping it",
+                    device
+                )
+                continue
+            jobs.append({
+                'device': device,
+                'user': secret['user'],
+                'password': secret['password'],
+                'chat_id': chat_id,
+                'time': dt
+            })
+
+            progress.update(
+                f"Rebooting at {dt}{facts.describe(device)}",
+                device
             )
 
+    start_reboots(jobs, progress)
     return
+
+
+# Run the reboots in the background
+#   Devices without credentials were skipped, so there may be no jobs
+def start_reboots(jobs, progress, rolling=False):
+    if not jobs:
+        progress.finish()
+        return
+
+    thread = threading.Thread(
+        target=rolling_reboot if rolling else reboot_all,
+        args=(jobs, progress,)
+    )
+    thread.start()
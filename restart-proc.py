@@ -13,6 +13,7 @@ Restrictions:
     Requires JunosPyEZ to be installed
     Requres a username/password to connect
     Requires NETCONF to be enabled on the target device
+    PyEZ and lxml are imported on first use
 
 To Do:
     TBA
@@ -21,76 +22,93 @@ Author:
     Luke Robertson - March 2023
 """
 
-from jnpr.junos import Device
-from jnpr.junos.exception import ConnectError
-from jnpr.junos.exception import RpcError
-from lxml import etree
-
-from core import crypto
+# PyEZ and lxml are imported in restart(), when they're needed
+#   This keeps plugin startup fast
+from concurrent.futures import ThreadPoolExecutor
 from core import teamschat
+from plugins.junos import credentials
+from plugins.junos import facts
+from plugins.junos import netconf
+from plugins.junos.progress import Progress
 import threading
 
 
 # Restart a process on a device
-def restart(device, user, password, process, chat_id, **kwargs):
+def restart(device, user, password, process, chat_id, progress=None,
+            **kwargs):
     '''
     Restart a process on a device
     Requires device name, username and password, and a process to restart
     Optionally can pass 'immediately=True' to use SIGKILL
+    Optionally can pass 'progress', a shared Progress object
+    Returns True if the restart was started, or False
     '''
 
+    if progress is None:
+        progress = Progress(chat_id)
+
+    from jnpr.junos.exception import ConnectAuthError
+    from jnpr.junos.exception import ConnectError
+    from jnpr.junos.exception import RpcError
+    from lxml import etree
+
     print(f"Connecting to {device}...")
     if process == 'forwarding':
         print("This will restart the forwarding process")
         print("You will lose access to the device temporarily")
         print("(5+ minutes for small devices)")
-        teamschat.send_chat(
+        progress.update(
             "Restarting the forwarding process, \
                 expect disruption for 5+ minutes",
-            chat_id
+            device
         )
 
     # Connect to the device
+    dev = None
     try:
-        with Device(host=device, user=user, passwd=password) as dev:
-            # Restart the process immediately (SIGKILL)
-            if 'immediately' in kwargs and kwargs['immediately'] is True:
-                result = dev.rpc.restart_daemon(
-                    immediately=True,
-                    daemon_name=process,
-                )
-                print("Restart Initiated (SIGKILL)")
-
-                # When using 'immediately', only a True or False is returned
-                if result:
-                    print("Restart Complete")
-                else:
-                    print("There were problems restarting this service")
-                    print("Maybe check the system logs")
-
-            # No args means restart gracefully (SIGTERM)
-            # If args are invalid, just a regular restart will do
+        dev = netconf.junos_connect(device, user, password, facts=False)
+        if not netconf.is_device(dev):
+            raise dev
+
+        # Keep the facts cache up to date, while we're connected
+        facts.get_facts(device, dev)
+
+        # Restart the process immediately (SIGKILL)
+        if 'immediately' in kwargs and kwargs['immediately'] is True:
+            result = dev.rpc.restart_daemon(
+                immediately=True,
+                daemon_name=process,
+            )
+            print("Restart Initiated (SIGKILL)")
+
+            # When using 'immediately', only a True or False is returned
+            if result:
+                response = "Restart Complete"
             else:
-                result = dev.rpc.restart_daemon(
-                    daemon_name=process
-                )
-                print("Restart Initiated (SIGTERM)")
-                response = etree.tostring(result, encoding='unicode')
-                response = response.replace("<output>", "")
-                response = response.replace("</output>", "")
-                print(response)
-            teamschat.send_chat(
-                f"{device}: {response}",
-                chat_id
+                response = "There were problems restarting this service"
+                print("Maybe check the system logs")
+            print(response)
+
+        # No args means restart gracefully (SIGTERM)
+        # If args are invalid, just a regular restart will do
+        else:
+            result = dev.rpc.restart_daemon(
+                daemon_name=process
             )
+            print("Restart Initiated (SIGTERM)")
+            response = etree.tostring(result, encoding='unicode')
+            response = response.replace("<output>", "")
+            response = response.replace("</output>", "")
+            print(response)
+        progress.update(response, device)
+        return True
 
     # Handle Connection error
     except ConnectError as err:
         print(f"There has been a connection error: {err}")
-        teamschat.send_chat(
-            f"Could not connect to {device}",
-            chat_id
-        )
+        if isinstance(err, ConnectAuthError):
+            credentials.invalidate('junos', device)
+        progress.update(f"Could not connect to {device}")
 
     # Handle an RPC error
     except RpcError as err:
@@ -98,44 +116,78 @@ def restart(device, user, password, process, chat_id, **kwargs):
         if process == 'forwarding':
             print(f"I have been disconnected from {device}")
             print("This is normal when restarting the forwarding process")
+            return True
 
         # Handle errors where a process is not running
         elif 'subsystem not running' in str(err):
             print(f"The {process} process cannot be started")
             print("It is not in use on this system")
-            teamschat.send_chat(
+            progress.update(
                 f"The {process} process cannot be started",
-                chat_id
+                device
             )
 
         # Handle a bad process name
         elif 'invalid daemon' in str(err):
             print(f"The {process} does not exist on this system")
             print("Maybe it's typed incorrectly?")
-            teamschat.send_chat(
+            progress.update(
                 f"The {process} does not exist on this system \
                     Is this a typo",
-                chat_id
+                device
             )
 
         # Handle other RPC errors
         else:
             print(f"RPC Error has occurred: {err}")
-            teamschat.send_chat(
+            progress.update(
                 f"RPC Error has occurred while connecting to {device} \
-                    <br>{err}",
-                chat_id
+                    <br>{err}"
             )
 
     # Handle a generic error
     except Exception as err:
         print(f"Error was: {err}")
-        teamschat.send_chat(
+        progress.update(
             f"An error has occurred while connecting to {device} \
-                <br>{err}",
-            chat_id
+                <br>{err}"
         )
 
+    # Restarting forwarding drops the session, so don't reuse it
+    finally:
+        netconf.junos_release(dev, discard=(process == 'forwarding'))
+
+    return False
+
+
+# Restart a process on a list of devices, and send one summary at the end
+#   Each job is a dictionary of arguments for restart()
+def restart_all(jobs, progress):
+    with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+        results = list(executor.map(
+            lambda job: restart(progress=progress, **job),
+            jobs
+        ))
+
+    # A single device reports its own result
+    if len(jobs) == 1:
+        progress.finish()
+        return
+
+    failed = [
+        job['device'] for job, result in zip(jobs, results) if not result
+    ]
+    summary = (
+        f"Restart {jobs[0]['process']}: {len(jobs) - len(failed)} of "
+        f"{len(jobs)} devices OK"
+    )
+    if failed:
+        summary += (
+            f"<br><span style=\"color:Red\">Failed: "
+            f"{', '.join(failed)}</span>"
+        )
+    progress.finish(summary)
+
 
 # Process the users phrase in order to restart a process
 def nlp_restart(chat_id, **kwargs):
@@ -165,12 +217,20 @@ def nlp_restart(chat_id, **kwargs):
             chat_id
         )
 
+    # Updates from all devices are coalesced into as few messages as possible
+    progress = Progress(chat_id)
+    jobs = []
+
     # Restart the processes
     for device in device_list:
-        secret = crypto.pw_decrypt(dev_type='junos', device=device)
+        secret = credentials.get_secret('junos', device)
         if not secret:
-            print("Could not get credentials")
-            return False
+            print(f"Could not get credentials for {device}")
+            progress.update(
+                "I couldn't get a password to connect, so I'm skipping it",
+                device
+            )
+            continue
 
         args = {
             'device': device,
@@ -184,9 +244,10 @@ def nlp_restart(chat_id, **kwargs):
         if 'immediate' in kwargs['message']:
             print(f"restarting the {process} process on {device} immediately")
 
-            teamschat.send_chat(
-                f"restarting the {process} process on {device} immediately",
-                chat_id
+            progress.update(
+                f"restarting the {process} process immediately"
+                f"{facts.describe(device)}",
+                device
             )
             args['immediately'] = True
 
@@ -194,14 +255,21 @@ def nlp_restart(chat_id, **kwargs):
         else:
             print(f"restarting the {process} process on {device}")
 
-            teamschat.send_chat(
-                f"restarting the {process} process on {device}",
-                chat_id
+            progress.update(
+                f"restarting the {process} process{facts.describe(device)}",
+                device
             )
 
-        # Run the thread
-        thread = threading.Thread(
-            target=restart,
-            kwargs=args
-        )
-        thread.start()
+        jobs.append(args)
+
+    # Devices without credentials were skipped, so there may be nothing to do
+    if not jobs:
+        progress.finish()
+        return
+
+    # Run the restarts in the background
+    thread = threading.Thread(
+        target=restart_all,
+        args=(jobs, progress,)
+    )
+    thread.start()
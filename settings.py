@@ -0,0 +1,37 @@
+"""
+Reads settings from the 'config' section of the plugin config
+
+Usage:
+    Call plugin_setting(name, default) to get a setting
+    The current config is read each time, so reloaded settings are used
+
+Restrictions:
+    Settings are only available once the Junos plugin is loaded;
+        until then, the default is returned
+
+To Do:
+    None
+"""
+
+from config import plugin_list
+
+
+def plugin_setting(name, default=None):
+    '''
+    Get a setting from the 'config' section of the plugin config
+
+    Parameters:
+        name : str
+            The name of the setting
+        default
+            The value to use if the setting is not in the config
+
+    Returns:
+        The value of the setting
+    '''
+
+    for plugin in plugin_list:
+        if 'Junos' in plugin['name']:
+            return plugin['handler'].config['config'].get(name, default)
+
+    return default
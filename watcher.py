@@ -0,0 +1,196 @@
+"""
+Watches rebooting devices, and measures how long they were down
+
+Usage:
+    Call watch() with a list of devices that have just been rebooted
+    Each device is reported to chat when it's back (or doesn't come back)
+    The downtime for each device is added to HISTORY_FILE
+
+Watching:
+    All devices are watched at once, in a single asyncio event loop
+    A device is up when its NETCONF port answers with an SSH banner
+    Each device is watched until it goes down, and comes back up
+    Checks back off from BACKOFF_START seconds, up to 'reboot_poll_interval'
+    Devices not back after 'reboot_wait_timeout' seconds are reported as failed
+
+History:
+    HISTORY_FILE (in 'local_log_dir') has one JSON object per line:
+        device, requested, down, up (ISO times), downtime (seconds)
+    'down' is the first check that failed, so downtime is slightly under
+
+Restrictions:
+    Only immediate reboots are watched
+
+To Do:
+    None
+"""
+
+from datetime import datetime
+from plugins.junos.settings import plugin_setting
+import asyncio
+import json
+import os
+import random
+import tempfile
+import termcolor
+import threading
+
+
+# The NETCONF port, checked to see if a device is up
+NETCONF_PORT = 830
+
+# How long (seconds) to wait for a device to answer a check
+PROBE_TIMEOUT = 5
+
+# The first wait between checks, and the defaults for the config settings
+#   Times are in seconds
+BACKOFF_START = 5
+REBOOT_POLL_INTERVAL = 20
+REBOOT_WAIT_TIMEOUT = 900
+
+# The file that records downtime, for trending
+HISTORY_FILE = 'reboot_history.jsonl'
+_history_lock = threading.Lock()
+
+
+# Check if a device's NETCONF port is up
+#   The SSH banner is read, so a port that opens but isn't ready is 'down'
+async def probe(device):
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(device, NETCONF_PORT),
+            PROBE_TIMEOUT
+        )
+    except (OSError, asyncio.TimeoutError):
+        return False
+
+    try:
+        banner = await asyncio.wait_for(reader.readline(), PROBE_TIMEOUT)
+        return banner.startswith(b'SSH-')
+    except (OSError, asyncio.TimeoutError):
+        return False
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+
+
+# Watch one device go down, and come back up
+#   Returns a record of when this happened
+async def watch_device(device, timeout, max_delay):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    record = {
+        'device': device,
+        'requested': datetime.now(),
+        'down': None,
+        'up': None
+    }
+
+    delay = BACKOFF_START
+    while loop.time() < deadline:
+        up = await probe(device)
+
+        # Waiting for the device to shut down
+        if record['down'] is None:
+            if not up:
+                record['down'] = datetime.now()
+                delay = BACKOFF_START
+
+        # Waiting for the device to come back
+        elif up:
+            record['up'] = datetime.now()
+            break
+
+        # Back off, with jitter so checks are spread out
+        await asyncio.sleep(delay * random.uniform(0.8, 1.2))
+        delay = min(delay * 2, max_delay)
+
+    return record
+
+
+# Format a number of seconds as minutes and seconds
+def duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes}m {seconds}s"
+
+
+# Add a record to the downtime history
+def save_history(record):
+    local_dir = plugin_setting('local_log_dir', tempfile.gettempdir())
+    path = os.path.join(local_dir, HISTORY_FILE)
+
+    entry = {
+        'device': record['device'],
+        'requested': record['requested'].isoformat(),
+        'down': record['down'] and record['down'].isoformat(),
+        'up': record['up'] and record['up'].isoformat(),
+        'downtime': record.get('downtime'),
+    }
+
+    with _history_lock:
+        try:
+            os.makedirs(local_dir, exist_ok=True)
+            with open(path, 'a') as history:
+                history.write(json.dumps(entry) + '\n')
+        except OSError as err:
+            print(termcolor.colored(
+                f"Could not save reboot history: {err}",
+                "red"
+            ))
+
+
+# Report a device's result to chat, and add it to the history
+#   Returns True if the device came back
+def report(record, progress, timeout):
+    device = record['device']
+    online = record['up'] is not None
+
+    if online:
+        record['downtime'] = round(
+            (record['up'] - record['down']).total_seconds()
+        )
+        message = (
+            f"Back online at {record['up'].strftime('%H:%M:%S')}, "
+            f"down for {duration(record['downtime'])}"
+        )
+    elif record['down'] is not None:
+        message = f"Not back online after {duration(timeout)}"
+    else:
+        message = f"Did not go down within {duration(timeout)}"
+
+    print(termcolor.colored(
+        f"{device}: {message}",
+        "green" if online else "red"
+    ))
+    progress.update(message, device)
+    save_history(record)
+
+    return online
+
+
+# Watch all devices at once
+#   Each device is reported as soon as it's back (or times out),
+#   not when the slowest device finishes
+#   Reports run in a thread, so a slow chat post doesn't delay the checks
+async def watch_all(devices, progress, timeout, max_delay):
+    online = {}
+    for task in asyncio.as_completed([
+        watch_device(device, timeout, max_delay) for device in devices
+    ]):
+        record = await task
+        online[record['device']] = await asyncio.to_thread(
+            report, record, progress, timeout
+        )
+    return online
+
+
+# Watch rebooting devices, and report when they're back
+#   Returns {device: True if it came back, otherwise False}
+def watch(devices, progress):
+    timeout = plugin_setting('reboot_wait_timeout', REBOOT_WAIT_TIMEOUT)
+    max_delay = plugin_setting('reboot_poll_interval', REBOOT_POLL_INTERVAL)
+
+    return asyncio.run(watch_all(devices, progress, timeout, max_delay))
@@ -0,0 +1,103 @@
+"""
+Decodes webhooks sent by the agent in the compact wire format
+
+Usage:
+    Call decode() with the raw body and headers, to get the event(s)
+    Call expand() on an event that has already been parsed from JSON
+
+Compact Format:
+    The agent sets the 'Junos-Format' header to FORMAT
+    Keys are shortened (see KEYS)
+    Known events are sent as a number (their position in EVENTS)
+    CPU details are sent as lists of [pid, user, cpu, command]
+    The body may be gzip compressed ('Content-Encoding: gzip')
+
+Restrictions:
+    EVENTS must match EVENT_IDS in agent.py
+    New events must only be added to the end of the list
+
+To Do:
+    None
+"""
+
+import gzip
+import json
+
+
+# The format version, sent in the 'Junos-Format' header
+FORMAT = 'compact-1'
+
+# Short keys, and the full names they stand for
+KEYS = {
+    'e': 'event',
+    'p': 'process',
+    'm': 'message',
+    'h': 'hostname',
+    'd': 'detail',
+}
+
+# Event names, by their numeric ID
+EVENTS = [
+    'DH_SVC_SENDMSG_FAILURE',
+    'LACP_INTF_MUX_STATE_CHANGED',
+    'LICENSE_EXPIRED_KEY_DELETED',
+    'SYSTEM_ABNORMAL_SHUTDOWN',
+    'TOPO_CH',
+    'UI_COMMIT',
+    'UI_COMMIT_NOT_CONFIRMED',
+    'UI_REBOOT_EVENT',
+    'UTMD_CF_CONFIG_DEPRECATED',
+    'ROOT_PORT',
+    'RTPERF_CPU_THRESHOLD_EXCEEDED',
+    'RTPERF_CPU_UTIL_MAX',
+    'SNMP_TRAP_LINK_DOWN',
+    'SNMP_TRAP_LINK_UP',
+]
+
+# The fields in each CPU detail entry
+DETAIL_FIELDS = ('pid', 'user', 'cpu', 'command')
+
+
+# Expand a compact event into the full format
+#   Events that are already in the full format are returned as they are
+def expand(event):
+    if 'e' not in event:
+        return event
+
+    full = {KEYS.get(key, key): value for key, value in event.items()}
+
+    # Numeric event IDs are looked up in the shared list
+    if isinstance(full['event'], int) and 0 <= full['event'] < len(EVENTS):
+        full['event'] = EVENTS[full['event']]
+    full['event'] = str(full['event'])
+
+    # The message is sent without the event name, so add it back
+    full['message'] = f"{full['event']}{full.get('message') or ''}"
+
+    # CPU details are sent as lists, rather than dictionaries
+    if isinstance(full.get('detail'), list):
+        full['detail'] = [
+            dict(zip(DETAIL_FIELDS, item)) if isinstance(item, list)
+            else item
+            for item in full['detail']
+        ]
+
+    full.setdefault('detail', '')
+    return full
+
+
+# Decode a raw webhook body into an event, or a list of events
+#   Handles gzip compression, and both the full and compact formats
+def decode(body, headers):
+    version = headers.get('Junos-Format')
+    if version is not None and version != FORMAT:
+        raise ValueError(f"Unknown webhook format: {version}")
+
+    if headers.get('Content-Encoding', '').lower() == 'gzip':
+        body = gzip.decompress(body)
+
+    data = json.loads(body)
+
+    if isinstance(data, list):
+        return [expand(event) for event in data if isinstance(event, dict)]
+    return expand(data)